@@ -58,7 +58,7 @@ def list_missing_schema(driver, extension):
     drvcls = loadmodules(driver, extension)
     props = drvcls.schema.get("items", {}).get("properties", {})
     mods = drvcls.listmodule()
-    ignore = ["name", "register", "when", "when_not", "with_items", "loop_control"]
+    ignore = ["name", "register", "when", "when_not", "with_items", "loop_control", "sink"]
     for k in sorted(mods.keys()):
         if k not in props:
             click.echo("missing schema: %s" % (k,))
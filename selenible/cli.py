@@ -75,10 +75,12 @@ def loadmodules(driver, extension):
 @click.option("--extension", "-x", multiple=True)
 @click.option("--step", is_flag=True, default=False)
 @click.option("--screenshot", is_flag=True, default=False)
+@click.option("--screenshot-dedup", type=int, default=None)
+@click.option("--screenshot-manifest", type=click.Path(), default=None)
 @click.option("-e", multiple=True)
 @click.option("--var", type=click.File('r'), required=False)
 @click.argument("input", type=click.File('r'), required=False)
-def run(input, driver, step, screenshot, var, e, extension):
+def run(input, driver, step, screenshot, screenshot_dedup, screenshot_manifest, var, e, extension):
     captureWarnings(True)
     drvcls = loadmodules(driver, extension)
     if input is not None:
@@ -100,7 +102,12 @@ def run(input, driver, step, screenshot, var, e, extension):
                     b.variables[k] = v
         b.step = step
         b.save_every = screenshot
-        b.run(prog)
+        b.save_dedup = screenshot_dedup
+        b.save_manifest = screenshot_manifest
+        try:
+            b.run(prog)
+        finally:
+            b.finish()
     else:
         click.echo("show usage: --help")
 
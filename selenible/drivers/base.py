@@ -6,6 +6,8 @@ import time
 import functools
 import getpass
 import copy
+import csv
+import itertools
 import io
 from logging import getLogger
 
@@ -13,14 +15,76 @@ import json
 import yaml
 import toml
 import jsonpath_rw
+import requests
 from threading import Lock
 from pkg_resources import resource_stream
 from lxml import etree
+try:
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    CSSSelector = None
 from PIL import Image
 from selenium.webdriver.common.by import By
 import selenium.common.exceptions
 from jinja2 import Template
 from ..version import VERSION
+from ..sink import sink_spec, open_sink
+
+
+# parser of structured files used by getvalue and var_from
+file_loaders = {
+    "yaml": yaml.safe_load,
+    "json": json.load,
+    "toml": toml.load,
+}
+
+
+@functools.lru_cache(maxsize=256)
+def compile_jsonpath(path):
+    return jsonpath_rw.parse(path)
+
+
+def csv_items(filename, encoding="utf-8", header=True, delimiter=","):
+    with open(filename, encoding=encoding, newline="") as f:
+        if header:
+            yield from csv.DictReader(f, delimiter=delimiter)
+        else:
+            yield from csv.reader(f, delimiter=delimiter)
+
+
+def jsonl_items(filename, encoding="utf-8"):
+    with open(filename, encoding=encoding) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def line_items(filename, encoding="utf-8"):
+    with open(filename, encoding=encoding) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line:
+                yield line
+
+
+def chunked(iterable, size):
+    """
+    >>> list(chunked(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    it = iter(iterable)
+    while True:
+        res = list(itertools.islice(it, size))
+        if len(res) == 0:
+            return
+        yield res
+
+
+def is_unsupported(e):
+    """WebDriverException means the command is not implemented by the driver"""
+    msg = str(getattr(e, "msg", None) or e).lower()
+    return any([x in msg for x in ("unknown command", "unrecognized command", "not implemented",
+                                   "unsupported", "not supported")])
 
 
 class Base:
@@ -31,6 +95,9 @@ class Base:
         self.lock = Lock()
         self.step = False
         self.save_every = False
+        self.save_dedup = None
+        self.save_manifest = None
+        self.last_shot = None
         self._driver = None
         self.variables = {
             "selenible_version": VERSION,
@@ -38,6 +105,18 @@ class Base:
         self.funcs = {}
         self.log = getLogger(self.__class__.__name__)
         self.browser_args = {}
+        self.finalizers = []
+        self.barriers = []
+        self.summary = {}
+        self.summary_lock = Lock()
+        self.sinks = {}
+        self.archives = {}
+        self.http = None
+        self.dom = None
+        self.filecache = {}
+        self.http_cookies = None
+        self.loop_index = []
+        self.element_screenshot = None
 
     @property
     def driver(self):
@@ -63,7 +142,34 @@ class Base:
     def printpdf(self, output_fn):
         raise Exception("please implement")
 
+    def add_finalizer(self, fn):
+        self.finalizers.append(fn)
+
+    def add_barrier(self, fn):
+        # wait for background jobs. called before finalizers
+        self.barriers.append(fn)
+
+    def add_summary(self, key, **kwargs):
+        # called from worker threads
+        with self.summary_lock:
+            ent = self.summary.setdefault(key, {})
+            for k, v in kwargs.items():
+                ent[k] = ent.get(k, 0) + v
+
+    def finish(self):
+        for lst in (self.barriers, self.finalizers):
+            while len(lst) != 0:
+                fn = lst.pop()
+                try:
+                    fn()
+                except Exception as e:
+                    self.log.error("error in finalizer %s: %s", fn, e)
+        for k, v in self.summary.items():
+            self.log.info("summary %s: %s", k, v)
+        self.summary = {}
+
     def __del__(self):
+        self.finish()
         self.shutdown_driver()
 
     @classmethod
@@ -126,6 +232,7 @@ class Base:
         res = None
         for cmd in prog:
             self.log.debug("cmd %s", cmd)
+            name = cmd.get("name") if isinstance(cmd, dict) else None
             res = self.run1(cmd)
             if self.step:
                 ans = input(
@@ -137,9 +244,36 @@ class Base:
                 elif ans == "c":
                     self.step = False
             if self.save_every:
-                self.do_screenshot({})
+                shot = {}
+                if self.save_dedup is not None:
+                    shot["dedup"] = self.save_dedup
+                if self.save_manifest is not None:
+                    shot["manifest"] = self.save_manifest
+                    shot["label"] = name
+                self.do_screenshot(shot)
         return res
 
+    def loop_items(self, withitem):
+        """iterable of with_items. files are read lazily"""
+        if isinstance(withitem, str):
+            return self.variables.get(withitem, None)
+        if not isinstance(withitem, dict):
+            return withitem
+        if "range" in withitem:
+            rg = withitem.get("range")
+            if isinstance(rg, (list, tuple)):
+                return range(*rg)
+            return range(int(rg))
+        encoding = withitem.get("encoding", "utf-8")
+        if "csv" in withitem:
+            return csv_items(withitem.get("csv"), encoding, withitem.get("header", True),
+                             withitem.get("delimiter", ","))
+        if "jsonl" in withitem:
+            return jsonl_items(withitem.get("jsonl"), encoding)
+        if "lines" in withitem:
+            return line_items(withitem.get("lines"), encoding)
+        return withitem
+
     def run1(self, cmd):
         withitem = self.render_dict(cmd.pop("with_items", None))
         delay = cmd.pop("delay", 0)
@@ -148,23 +282,29 @@ class Base:
             loopvar = loopctl.get("loop_var", "item")
             loopiter = loopctl.get("loop_iter", "iter")
             start = time.time()
-            if isinstance(withitem, dict) and "range" in withitem:
-                rg = withitem.get("range")
-                if isinstance(rg, (list, tuple)):
-                    withitem = range(*rg)
-                else:
-                    withitem = range(int(rg))
-            elif isinstance(withitem, str):
-                withitem = self.variables.get(withitem, None)
-            self.log.info("start loop: %d times", len(withitem))
+            withitem = self.loop_items(withitem)
+            chunk = loopctl.get("chunk")
+            if chunk is not None:
+                withitem = chunked(withitem, chunk)
+            progress = loopctl.get("progress")
+            total = len(withitem) if hasattr(withitem, "__len__") else None
+            self.log.info("start loop: %s times", total if total is not None else "unknown")
+            self.loop_index.append(None)
+            res = None
             for i, j in enumerate(withitem):
                 self.variables[loopvar] = j
                 self.variables[loopiter] = i
-                self.log.info("loop by %d: %s", i, j)
+                self.loop_index[-1] = i
+                self.log.debug("loop by %d: %s", i, j)
                 res = self.run1(cmd.copy())
                 time.sleep(delay)
-            self.variables.pop(loopvar)
-            self.variables.pop(loopiter)
+                if progress and (i + 1) % progress == 0:
+                    elapsed = time.time() - start
+                    self.log.info("loop progress: %d/%s, %.1f items/sec", i + 1,
+                                  total if total is not None else "?", (i + 1) / elapsed)
+            self.loop_index.pop()
+            self.variables.pop(loopvar, None)
+            self.variables.pop(loopiter, None)
             self.log.info("finish loop: %f second", time.time() - start)
             return res
         # cmd = self.render_dict(cmd)
@@ -178,6 +318,7 @@ class Base:
             self.log.info("skip(when_not) %s", repr(name))
             return
         register = self.render_dict(cmd.pop("register", None))
+        sink = self.render_dict(cmd.pop("sink", None))
         ignoreerr = self.render_dict(cmd.pop("ignore_error", False))
         if len(cmd) != 1:
             raise Exception("too many parameters: %s" % (cmd.keys()))
@@ -234,6 +375,8 @@ class Base:
                 if register is not None:
                     self.log.debug("register %s = %s", register, res)
                     self.variables[register] = res
+                if sink is not None:
+                    self.write_sink(sink, name, start, res)
                 self.log.info("finish %s %f second",
                               repr(name), time.time() - start)
             elif hasattr(self, mtdname2):
@@ -241,16 +384,77 @@ class Base:
                 mtd = getattr(self, mtdname2)
                 param = cmd.get(c)
                 self.log.debug("%s %s %s", name, c, param)
+                start = time.time()
                 with self.lock:
                     res = mtd(c, param)
                 if register is not None:
                     self.log.debug("register %s = %s", register, res)
                     self.variables[register] = res
+                if sink is not None:
+                    self.write_sink(sink, name, start, res)
             else:
                 raise Exception("module not found: %s" % (c))
             time.sleep(delay)
             return res
 
+    def get_sink(self, param):
+        kind, filename, opts = sink_spec(param)
+        key = (kind, filename)
+        if key not in self.sinks:
+            self.log.info("open sink %s: %s", kind, filename)
+            snk = open_sink(kind, filename, opts)
+            self.sinks[key] = snk
+            self.add_finalizer(functools.partial(self.close_sink, key))
+        return self.sinks[key]
+
+    def close_sink(self, key):
+        snk = self.sinks.pop(key, None)
+        if snk is not None:
+            snk.close()
+
+    def http_session(self, poolsize=16):
+        # connection pool shared during the run
+        if self.http is None:
+            self.http = requests.Session()
+            self.http_poolsize = 0
+            self.add_finalizer(self.close_http)
+        if poolsize > self.http_poolsize:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=poolsize)
+            self.http.mount("http://", adapter)
+            self.http.mount("https://", adapter)
+            self.http_poolsize = poolsize
+        return self.http
+
+    def close_http(self):
+        if self.http is not None:
+            self.http.close()
+            self.http = None
+            self.http_cookies = None
+
+    def sync_cookies(self, cookies, poolsize=16):
+        # copy browser cookies to the session, only when changed
+        sess = self.http_session(poolsize)
+        if cookies == self.http_cookies:
+            return sess
+        self.log.debug("sync cookies: %d", len(cookies))
+        sess.cookies.clear()
+        for ck in cookies:
+            sess.cookies.set(ck.get("name"), ck.get("value"),
+                             path=ck.get("path", "/"), domain=ck.get("domain", ""),
+                             secure=ck.get("secure", False))
+        self.http_cookies = copy.deepcopy(cookies)
+        return sess
+
+    def write_sink(self, param, name, start, res):
+        record = {
+            "name": name,
+            "loop": self.loop_index[-1] if len(self.loop_index) != 0 else None,
+            "start": start,
+            "elapsed": time.time() - start,
+            "result": res,
+        }
+        self.get_sink(param).write(record)
+
     def do2_defun(self, funcname, params):
         """
         - name: define func1
@@ -338,6 +542,25 @@ class Base:
             fp.write(data)
         return data
 
+    def saveshot_element(self, elem):
+        if self.element_screenshot is False:
+            return None
+        try:
+            data = elem.screenshot_as_png
+            self.element_screenshot = True
+            return data
+        except (AttributeError, selenium.common.exceptions.UnknownMethodException) as e:
+            self.log.info("element screenshot is not supported: %s", e)
+            self.element_screenshot = False
+        except selenium.common.exceptions.WebDriverException as e:
+            if is_unsupported(e):
+                self.log.info("element screenshot is not supported: %s", e)
+                self.element_screenshot = False
+            else:
+                # e.g. element is out of viewport or stale. fallback for this element only
+                self.log.info("element screenshot failed: %s", e)
+        return None
+
     findmap = {
         "id": By.ID,
         "xpath": By.XPATH,
@@ -401,6 +624,69 @@ class Base:
             return [self.driver.switch_to.active_element]
         return []
 
+    # locator -> (xpath, variable)
+    localmap = {
+        By.ID: "//*[@id=$v]",
+        By.NAME: "//*[@name=$v]",
+        By.TAG_NAME: "//*[name()=$v]",
+        By.CLASS_NAME: "//*[contains(concat(' ', normalize-space(@class), ' '), concat(' ', $v, ' '))]",
+        By.LINK_TEXT: "//a[normalize-space(string(.))=$v]",
+        By.PARTIAL_LINK_TEXT: "//a[contains(string(.), $v)]",
+    }
+
+    def findlocal(self, tree, param):
+        """find elements from lxml tree instead of browser. None if locator cannot be evaluated locally"""
+        k, v = self.getlocator(param)
+        if k is None:
+            return []
+        if k == By.XPATH:
+            res = tree.xpath(v)
+        elif k == By.CSS_SELECTOR and CSSSelector is not None:
+            res = CSSSelector(v)(tree)
+        elif k in self.localmap:
+            res = tree.xpath(self.localmap[k], v=v)
+        else:
+            self.log.debug("locator %s is not supported locally: %s", k, v)
+            return None
+        return [x for x in res if isinstance(x, etree._Element)]
+
+    def snapshot_tree(self):
+        """lxml tree of DOM snapshot (see snapshot module). None if not taken or page moved"""
+        if self.dom is None:
+            return None
+        if self.variables.get("current_url", self.dom["url"]) != self.dom["url"]:
+            self.log.debug("snapshot expired: %s -> %s", self.dom["url"], self.variables.get("current_url"))
+            self.dom = None
+            return None
+        return self.dom["tree"]
+
+    def findtext(self, param):
+        """text of elements. from snapshot if available"""
+        tree = self.snapshot_tree()
+        if tree is not None:
+            elems = self.findlocal(tree, param)
+            if elems is not None:
+                return ["".join(x.itertext()) for x in elems]
+        return [x.text for x in self.findmany(param)]
+
+    def load_file(self, kind, filename):
+        """parsed file. cached while mtime and size are not changed. do not modify the result"""
+        try:
+            st = os.stat(filename)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            # not a regular file (or cannot stat): not cached
+            stamp = None
+        key = (kind, filename)
+        ent = self.filecache.get(key)
+        if stamp is not None and ent is not None and ent[0] == stamp:
+            return ent[1]
+        with open(filename) as f:
+            data = file_loaders[kind](f)
+        if stamp is not None:
+            self.filecache[key] = (stamp, data)
+        return data
+
     def getvalue(self, param):
         if isinstance(param, str):
             return param
@@ -413,22 +699,12 @@ class Base:
         elif "pipe" in param:
             cmd = param.get("pipe")
             return self.runcmd(cmd, encoding).strip()
-        elif "yaml" in param:
-            p = param.get("yaml")
-            with open(p.get("file")) as f:
-                data = yaml.safe_load(f)
-                return jsonpath_rw.parse(p.get("path", "*")).find(data)[0].value
-        elif "json" in param:
-            p = param.get("json")
-            with open(p.get("file")) as f:
-                data = json.load(f)
-                return jsonpath_rw.parse(p.get("path", "*")).find(data)[0].value
-        elif "toml" in param:
-            p = param.get("toml")
-            with open(p.get("file")) as f:
-                data = toml.load(f)
-                return jsonpath_rw.parse(p.get("path", "*")).find(data)[0].value
-        elif "input" in param:
+        for kind in file_loaders.keys():
+            if kind in param:
+                p = param.get(kind)
+                data = self.load_file(kind, p.get("file"))
+                return copy.deepcopy(compile_jsonpath(p.get("path", "*")).find(data)[0].value)
+        if "input" in param:
             return input(param.get("input"))
         elif "input_password" in param:
             return getpass.getpass(param.get("input_password"))
@@ -489,6 +765,12 @@ class Base:
                 elif k in ("not_displayed", "undisplayed"):
                     for e in self.findmany(v):
                         res.append(not e.is_displayed())
+                elif k in ("exists",):
+                    res.append(len(self.findtext(v)) != 0)
+                elif k in ("not_exists",):
+                    res.append(len(self.findtext(v)) == 0)
+                elif k in ("text_contains",):
+                    res.append(any([v.get("text", "") in x for x in self.findtext(v)]))
                 elif k in ("defined",):
                     if isinstance(v, (tuple, list)):
                         res.extend([x in self.variables for x in v])
@@ -1,3 +1,4 @@
+import requests
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from . import Base
@@ -11,6 +12,28 @@ class Chrome(Base):
         self.log.debug("chrome: %s", self.browser_args)
         return webdriver.Chrome(**self.browser_args)
 
+    def devtools_websocket(self):
+        """websocket url of DevTools for current window"""
+        addr = (self.driver.capabilities or {}).get("goog:chromeOptions", {}).get("debuggerAddress")
+        if addr is None:
+            return None
+        try:
+            targets = requests.get("http://%s/json" % (addr), timeout=5).json()
+        except (requests.RequestException, ValueError) as e:
+            self.log.info("cannot get devtools targets: %s", e)
+            return None
+        pages = [x for x in targets if x.get("type") == "page" and "webSocketDebuggerUrl" in x]
+        handle = self.driver.current_window_handle
+        for t in pages:
+            if t.get("id") in (handle, handle.replace("CDwindow-", "")):
+                return t.get("webSocketDebuggerUrl")
+        for t in pages:
+            if t.get("url") == self.driver.current_url:
+                return t.get("webSocketDebuggerUrl")
+        if len(pages) != 0:
+            return pages[0].get("webSocketDebuggerUrl")
+        return None
+
     def do_network_conditions(self, params):
         """
         - name: network emulation settings
@@ -1,12 +1,18 @@
+import io
+import os
 import math
 import time
 import urllib.parse
 import yaml
+from lxml import etree
+from PIL import Image
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.alert import Alert
 from selenium.webdriver.support.select import Select
+from .imageproc import crop_image, resize_image, encode_image, get_archive, get_optimizer, pngwriter
+from .imageproc import image_hash, hash_distance
 
 
 open_schema = yaml.safe_load("""
@@ -53,8 +59,21 @@ oneOf:
       - type: object
         properties:
           output: {type: string}
-          optimize: {type: boolean}
+          optimize:
+            oneOf:
+              - type: boolean
+              - enum: [background]
           archive: {type: string}
+          all: {type: boolean}
+          dedup: {type: integer}
+          manifest: {type: string}
+          label: {type: string}
+          fullpage: {type: boolean}
+          header:
+            oneOf:
+              - type: number
+              - enum: [auto]
+          footer: {type: number}
           crop:
             oneOf:
               - type: string
@@ -68,6 +87,163 @@ oneOf:
 """)
 
 
+def elem_box(elem):
+    x1 = elem.location['x']
+    y1 = elem.location['y']
+    x2 = x1 + elem.size['width']
+    y2 = y1 + elem.size['height']
+    return [x1, y1, x2, y2]
+
+
+def save_screenshot(self, param, output, data, img=None):
+    # decode once, apply crop/resize in memory, encode once
+    if param.get("crop", None) is not None:
+        if img is None:
+            img = Image.open(io.BytesIO(data))
+        img = crop_image(img, param.get("crop"))
+    if param.get("resize", None) is not None:
+        if img is None:
+            img = Image.open(io.BytesIO(data))
+        img = resize_image(img, param.get("resize"))
+    if img is not None:
+        data = encode_image(img, output)
+    if param.get("archive", False) and not param.get("optimize", False):
+        # no need to touch local file
+        self.log.debug("archive %s %s", param.get("archive"), output)
+        get_archive(self, param.get("archive")).add(output, data)
+        return output
+    with open(output, "wb") as f:
+        f.write(data)
+    return postprocess_screenshot(self, param, output)
+
+
+def postprocess_screenshot(self, param, output):
+    # optimize and archive local file
+    if param.get("optimize", False) == "background":
+        arc = None
+        if param.get("archive", False):
+            arc = get_archive(self, param.get("archive"))
+        get_optimizer(self).submit(output, output, archive=arc)
+        return output
+    if param.get("optimize", False):
+        nparam = {
+            "input": output,
+        }
+        self.do_image_optimize(nparam)
+    if param.get("archive", False):
+        nparam = {
+            "output": param.get("archive"),
+            "input": output,
+            "delete": True,
+        }
+        self.do_image_archive(nparam)
+    return output
+
+
+def dedup_screenshot(self, param, output, data):
+    # skip writing when the capture looks like the previous one
+    threshold = param.get("dedup")
+    h = image_hash(Image.open(io.BytesIO(data)))
+    res = {"image": output, "duplicate": False, "distance": None}
+    if self.last_shot is not None:
+        res["distance"] = hash_distance(h, self.last_shot[0])
+        if res["distance"] <= threshold:
+            res["image"] = self.last_shot[1]
+            res["duplicate"] = True
+    if not res["duplicate"]:
+        self.last_shot = (h, save_screenshot(self, param, output, data))
+    self.log.debug("dedup %s: %s", output, res)
+    write_manifest(self, param, res)
+    return res["image"]
+
+
+def write_manifest(self, param, res):
+    if param.get("manifest") is None:
+        return
+    record = {
+        "name": param.get("label"),
+        "loop": self.loop_index[-1] if len(self.loop_index) != 0 else None,
+        "start": time.time(),
+        "elapsed": 0,
+        "result": res,
+    }
+    self.get_sink(param.get("manifest")).write(record)
+
+
+fullpage_metrics_js = """return [window.pageXOffset, window.pageYOffset,
+Math.max(document.body.scrollHeight, document.documentElement.scrollHeight),
+window.innerHeight, window.devicePixelRatio || 1];"""
+
+# bottom of fixed/sticky elements at the top of viewport
+fixed_header_js = """var h = 0;
+document.querySelectorAll("*").forEach(function(e) {
+  var s = window.getComputedStyle(e);
+  if ((s.position == "fixed" || s.position == "sticky") && s.display != "none") {
+    var r = e.getBoundingClientRect();
+    if (r.top <= 0 && r.bottom > h && r.bottom < window.innerHeight / 2) { h = r.bottom; }
+  }
+});
+return h;"""
+
+
+def fullpage_screenshot(self, param, output):
+    """scroll viewport and stitch captures. bands are written to png one by one"""
+    if os.path.splitext(output)[1].lower() != ".png":
+        raise Exception("fullpage screenshot writes png only: %s" % (output))
+    if param.get("crop") is not None or param.get("resize") is not None:
+        raise Exception("crop/resize cannot be used with fullpage: %s" % (param))
+    x0, y0, total, vh, dpr = self.driver.execute_script(fullpage_metrics_js)
+    header = param.get("header", 0)
+    if header == "auto":
+        header = self.driver.execute_script(fixed_header_js)
+    footer = param.get("footer", 0)
+    step = vh - header - footer
+    if step <= 0:
+        raise Exception("header/footer too large: viewport=%s, header=%s, footer=%s" % (vh, header, footer))
+    self.log.info("fullpage: height=%s, viewport=%s, header=%s, footer=%s", total, vh, header, footer)
+    wr = None
+    written = 0  # rows in output
+    y = 0
+    idx = 0
+    try:
+        while True:
+            t1 = time.time()
+            cur = self.driver.execute_script(scrollto("scrollTo", 0, y) + "; return window.pageYOffset;")
+            img = Image.open(io.BytesIO(self.saveshot()))
+            t2 = time.time()
+            if wr is None:
+                if img.height >= int(total * dpr):
+                    # driver captures whole page (e.g. phantomjs)
+                    self.log.info("fullpage: captured whole page at once")
+                    img.save(output)
+                    break
+                scale = img.height / vh
+                height = int(round(total * scale))
+                wr = pngwriter(output, img.width, height, "RGBA" if "A" in img.getbands() else "RGB")
+            offset = int(round(cur * scale))
+            # trim rows already written (overlap and fixed header) and fixed footer
+            top = written - offset
+            if cur + vh >= total:
+                bottom = min(img.height, height - offset)
+            else:
+                bottom = int(round((vh - footer) * scale))
+            if top < 0 or bottom <= top:
+                raise Exception("page cannot be scrolled: y=%s, offset=%s" % (y, cur))
+            wr.write(img.crop((0, top, wr.width, bottom)))
+            written += bottom - top
+            self.log.info("band %d: y=%s, rows=%d, capture=%.3f sec, write=%.3f sec", idx, cur, bottom - top,
+                          t2 - t1, time.time() - t2)
+            idx += 1
+            if written >= height:
+                break
+            y = cur + step
+        if wr is not None:
+            wr.close()
+    finally:
+        self.driver.execute_script(scrollto("scrollTo", x0, y0))
+    return postprocess_screenshot(self, param, output)
+
+
 def Base_screenshot(self, param):
     """
     - name: take screenshot 1
@@ -75,10 +251,25 @@ def Base_screenshot(self, param):
     - name: take screenshot 2
       screenshot:
         output: shot2.png
-        optimize: true
+        optimize: true   # or "background"
         archive: images.tar
         crop: auto
         resize: [800, 600]
+    - name: skip writing when nothing changed since previous shot
+      screenshot:
+        dedup: 4    # max hamming distance of perceptual hash
+        manifest: shots.jsonl   # one record per shot (also without dedup)
+    - name: scroll and stitch whole page
+      screenshot:
+        output: page.png
+        fullpage: true
+        header: auto   # or height of fixed header in CSS pixels
+        footer: 0
+    - name: take screenshot of each element (shot3_0.png, shot3_1.png, ...)
+      screenshot:
+        output: shot3.png
+        tag: img
+        all: true
     """
     self.log.debug("screenshot %s", param)
     if isinstance(param, str):
@@ -94,43 +285,40 @@ def Base_screenshot(self, param):
             output += time.strftime("%Y%m%d_%H%M%S", time.localtime(ts))
             output += "_%03d.png" % (msec)
             self.log.debug("filename generated %s", output)
-        self.saveshot(output)
-        elem = self.findmany2one(param)
-        if elem is not None:
-            x1 = elem.location['x']
-            y1 = elem.location['y']
-            x2 = x1 + elem.size['width']
-            y2 = y1 + elem.size['height']
-            nparam = {
-                "input": output,
-                "size": [x1, y1, x2, y2],
-            }
-            self.do_image_crop(nparam)
-        if param.get("crop", None) is not None:
-            nparam = {
-                "input": output,
-                "size": param.get("crop"),
-            }
-            self.do_image_crop(nparam)
-        if param.get("resize", None) is not None:
-            nparam = {
-                "input": output,
-                "size": param.get("resize"),
-            }
-            self.do_image_resize(nparam)
-        if param.get("optimize", False):
-            nparam = {
-                "input": output,
-            }
-            self.do_image_optimize(nparam)
-        if param.get("archive", False):
-            nparam = {
-                "output": param.get("archive"),
-                "input": output,
-                "delete": True,
-            }
-            self.do_image_archive(nparam)
-        return output
+        batch = param.get("all", False)
+        if batch:
+            elems = self.findmany(param)
+        else:
+            elems = [self.findmany2one(param)]
+        if elems == [None]:
+            if param.get("dedup") is not None and not param.get("fullpage", False):
+                return dedup_screenshot(self, param, output, self.saveshot())
+            if param.get("fullpage", False):
+                res = fullpage_screenshot(self, param, output)
+            else:
+                res = save_screenshot(self, param, output, self.saveshot())
+            write_manifest(self, param, {"image": res, "duplicate": False, "distance": None})
+            return res
+        base, ext = os.path.splitext(output)
+        page = None
+        res = []
+        for i, elem in enumerate(elems):
+            if batch:
+                fname = "%s_%d%s" % (base, i, ext)
+            else:
+                fname = output
+            data = self.saveshot_element(elem)
+            img = None
+            if data is None:
+                # fallback: crop from (at most one) full page capture
+                if page is None:
+                    page = Image.open(io.BytesIO(self.saveshot()))
+                img = crop_image(page, elem_box(elem))
+            res.append(save_screenshot(self, param, fname, data, img))
+            write_manifest(self, param, {"image": res[-1], "duplicate": False, "distance": None})
+        if batch:
+            return res
+        return res[0]
 
 
 click_schema = {"$ref": "#/definitions/common/locator"}
@@ -350,6 +538,35 @@ allOf:
 """)
 
 
+def inner_html(elem):
+    res = [elem.text or ""]
+    res.extend([etree.tostring(x, method="html", encoding=str) for x in elem])
+    return "".join(res)
+
+
+def save_snapshot(self, mode, locator, param):
+    """None if locator cannot be evaluated in the snapshot"""
+    tree = self.snapshot_tree()
+    if mode == "title":
+        return [tree.findtext(".//title") or ""]
+    if locator[0] is None:
+        if mode in ("source", "source_outer"):
+            return [self.dom["source"]]
+        elif mode == "text":
+            return [tree.xpath("string(/html)")]
+        return None
+    elems = self.findlocal(tree, param)
+    if elems is None:
+        return None
+    if mode == "source":
+        return [inner_html(x) for x in elems]
+    elif mode == "source_outer":
+        return [etree.tostring(x, method="html", encoding=str, with_tail=False) for x in elems]
+    elif mode == "text":
+        return ["".join(x.itertext()) for x in elems]
+    return None
+
+
 def Base_save(self, param):
     """
     - name: save page title
@@ -365,10 +582,19 @@ def Base_save(self, param):
         mode: text
         id: element2
       register: title1
+    - name: read from DOM snapshot (see snapshot module)
+      save:
+        mode: text
+        class: item
     """
     mode = param.get("mode", "source")
     locator = self.getlocator(param)
-    if mode == "source":
+    txt = None
+    if self.snapshot_tree() is not None:
+        txt = save_snapshot(self, mode, locator, param)
+    if txt is not None:
+        pass
+    elif mode == "source":
         if locator[0] is None:
             txt = [self.driver.page_source]
         else:
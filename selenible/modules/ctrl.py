@@ -1,12 +1,19 @@
+import os
+import copy
 import time
 import json
 import yaml
-import toml
+import sqlite3
+import hashlib
+import collections
 import tempfile
+import functools
+import threading
+import concurrent.futures
 import urllib.parse
-import requests
 from subprocess import DEVNULL
 from lxml import etree
+import lxml.html
 import logging.config
 
 
@@ -81,14 +88,11 @@ def Base_var_from(self, param):
         toml: filename
     """
     if "yaml" in param:
-        with open(param.get("yaml")) as f:
-            self.do_var(yaml.safe_load(f))
+        self.do_var(copy.deepcopy(self.load_file("yaml", param.get("yaml"))))
     if "json" in param:
-        with open(param.get("json")) as f:
-            self.do_var(json.load(f))
+        self.do_var(copy.deepcopy(self.load_file("json", param.get("json"))))
     if "toml" in param:
-        with open(param.get("toml")) as f:
-            self.do_var(toml.load(f))
+        self.do_var(copy.deepcopy(self.load_file("toml", param.get("toml"))))
 
 
 var_from_if_not_schema = var_from_schema
@@ -103,14 +107,11 @@ def Base_var_from_if_not(self, param):
         toml: filename
     """
     if "yaml" in param:
-        with open(param.get("yaml")) as f:
-            self.do_var_if_not(yaml.safe_load(f))
+        self.do_var_if_not(copy.deepcopy(self.load_file("yaml", param.get("yaml"))))
     if "json" in param:
-        with open(param.get("json")) as f:
-            self.do_var_if_not(json.load(f))
+        self.do_var_if_not(copy.deepcopy(self.load_file("json", param.get("json"))))
     if "toml" in param:
-        with open(param.get("toml")) as f:
-            self.do_var_if_not(toml.load(f))
+        self.do_var_if_not(copy.deepcopy(self.load_file("toml", param.get("toml"))))
 
 
 def Base_runcmd(self, param):
@@ -314,10 +315,31 @@ xslt_schema = yaml.safe_load("""
 type: object
 properties:
   proc: {type: string}
+  proc_file: {type: string}
   output: {type: string}
 """)
 
 
+@functools.lru_cache(maxsize=32)
+def compile_xslt(digest, src):
+    return etree.XSLT(etree.XML(src))
+
+
+@functools.lru_cache(maxsize=32)
+def load_xslt(filename, mtime, size):
+    return etree.XSLT(etree.parse(filename))
+
+
+def get_xslt(param):
+    """compiled stylesheet. cached by hash of stylesheet, or (filename, mtime, size)"""
+    filename = param.get("proc_file")
+    if filename is not None:
+        st = os.stat(filename)
+        return load_xslt(filename, st.st_mtime, st.st_size)
+    src = param.get("proc", "")
+    return compile_xslt(hashlib.sha256(src.encode("utf-8")).hexdigest(), src)
+
+
 def Base_xslt(self, param):
     """
     - name: transform
@@ -329,19 +351,24 @@ def Base_xslt(self, param):
                 </xsl:template>
             </xsl:stylesheet>
         output: outfile.txt
+    - name: transform each element with stylesheet file
+      xslt:
+        proc_file: transform.xsl
+        select: div.item
     """
     if isinstance(param, dict):
-        proc = etree.XSLT(etree.XML(param.get("proc", "")))
+        proc = get_xslt(param)
         output = param.get("output", None)
-        elem = self.findmany(param)
-        if elem == [None]:
-            p = etree.parse(self.driver.page_source)
-            rst = [str(proc(p))]
+        # parse page once, and apply to elements in the tree
+        tree = etree.HTML(self.driver.page_source)
+        if self.getlocator(param)[0] is None:
+            rst = [str(proc(tree))]
         else:
-            rst = []
-            for e in elem:
-                p = etree.parse(e.get_attribute("innerHTML"))
-                rst.append(str(proc(p)))
+            elems = self.findlocal(tree, param)
+            if elems is None:
+                # e.g. css selector without cssselect: ask browser
+                elems = [lxml.html.fragment_fromstring(e.get_attribute("outerHTML")) for e in self.findmany(param)]
+            rst = [str(proc(e)) for e in elems]
         if output is not None:
             with open(output, "w") as f:
                 for x in rst:
@@ -360,9 +387,249 @@ properties:
   headers: {type: object}
   json: {type: boolean}
   output: {type: string}
+  resume: {type: boolean}
+  chunk: {type: integer}
+  items:
+    oneOf:
+      - type: string
+      - type: array
+  workers: {type: integer}
+  per_host: {type: integer}
+  cache:
+    oneOf:
+      - type: boolean
+      - type: string
 """)
 
 
+def browser_cookies(self):
+    # cookies are read at the beginning of each step (variables["cookies"])
+    cookies = self.variables.get("cookies")
+    if cookies is None and self._driver is not None:
+        cookies = self.driver.get_cookies()
+    return cookies or []
+
+
+def stream_download(self, resp, output, chunk=1024 * 1024, offset=0, interval=5.0):
+    """write response body to output chunk by chunk. returns bytes written"""
+    mode = "ab" if offset != 0 else "wb"
+    total = resp.headers.get("content-length")
+    if total is not None:
+        total = int(total) + offset
+    start = last = time.time()
+    size = 0
+    with open(output, mode) as f:
+        for data in resp.iter_content(chunk):
+            f.write(data)
+            size += len(data)
+            now = time.time()
+            if now - last >= interval:
+                last = now
+                self.log.info("download %s: %d/%s bytes, %.1f KB/s", output, offset + size, total,
+                              size / (now - start) / 1024)
+    elapsed = time.time() - start
+    self.log.info("download %s: %d bytes, %.3f sec, %.1f KB/s", output, offset + size, elapsed,
+                  size / max(elapsed, 1e-6) / 1024)
+    return size
+
+
+class httpcache:
+    """ETag/Last-Modified of downloaded files. output file itself is reused on 304"""
+
+    def __init__(self, path=None):
+        if path is None or path is True:
+            base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+            path = os.path.join(base, "selenible", "download.db")
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS validators (url TEXT, output TEXT, etag TEXT, "
+                        "last_modified TEXT, size INTEGER, mtime REAL, PRIMARY KEY (url, output))")
+
+    def headers(self, url, output):
+        """conditional request headers. empty if output is not same as downloaded"""
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified, size, mtime FROM validators "
+                                  "WHERE url=? AND output=?", (url, output)).fetchone()
+        if row is None:
+            return {}
+        etag, last_modified, size, mtime = row
+        try:
+            st = os.stat(output)
+        except FileNotFoundError:
+            return {}
+        if st.st_size != size or st.st_mtime != mtime:
+            return {}
+        res = {}
+        if etag is not None:
+            res["If-None-Match"] = etag
+        if last_modified is not None:
+            res["If-Modified-Since"] = last_modified
+        return res
+
+    def put(self, url, output, etag, last_modified):
+        st = os.stat(output)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?, ?, ?)",
+                            (url, output, etag, last_modified, st.st_size, st.st_mtime))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def get_httpcache(self, path):
+    if getattr(self, "httpcache", None) is None:
+        self.httpcache = httpcache(path)
+        self.add_finalizer(functools.partial(close_httpcache, self))
+    return self.httpcache
+
+
+def close_httpcache(self):
+    cache = getattr(self, "httpcache", None)
+    if cache is not None:
+        self.httpcache = None
+        cache.close()
+
+
+def download_file(self, sess, url, output, method="get", query=None, headers=None, timeout=None,
+                  resume=False, chunk=1024 * 1024, cache=None):
+    """download url to output. returns (status code, bytes written)"""
+    headers = dict(headers or {})
+    offset = 0
+    if resume and os.path.exists(output):
+        offset = os.stat(output).st_size
+        if offset != 0:
+            headers["Range"] = "bytes=%d-" % (offset)
+    elif cache is not None:
+        headers.update(cache.headers(url, output))
+    with sess.request(method, url, params=query, headers=headers, timeout=timeout, stream=True) as resp:
+        if offset != 0 and resp.status_code == 416:
+            self.log.info("download %s: already completed", output)
+            return resp.status_code, 0
+        if resp.status_code == 304 and cache is not None:
+            size = os.stat(output).st_size
+            self.log.info("download %s: not modified. reuse %s", url, output)
+            self.add_summary("download", requests=1, hit=1, saved=size)
+            return resp.status_code, 0
+        if resp.status_code >= 400:
+            self.log.warning("download %s: status %d", url, resp.status_code)
+            return resp.status_code, 0
+        if offset != 0 and resp.status_code != 206:
+            self.log.info("download %s: server does not support range. restart", output)
+            offset = 0
+        elif offset != 0:
+            self.log.info("download %s: resume from %d", output, offset)
+        size = stream_download(self, resp, output, chunk, offset)
+        if cache is not None:
+            etag, last_modified = resp.headers.get("etag"), resp.headers.get("last-modified")
+            if etag is not None or last_modified is not None:
+                cache.put(url, output, etag, last_modified)
+            self.add_summary("download", requests=1, miss=1, bytes=size)
+        return resp.status_code, size
+
+
+def download_items(self, param):
+    """list of dict(url, output, ...). each item inherits parameters from param"""
+    items = param.get("items")
+    if isinstance(items, str):
+        items = self.variables.get(items)
+    if not isinstance(items, (list, tuple)):
+        raise Exception("invalid items: %s" % (param.get("items")))
+    outdir = param.get("output")
+    res = []
+    for x in items:
+        ent = {k: v for k, v in param.items() if k not in ("items", "output", "workers", "per_host")}
+        if isinstance(x, str):
+            x = {"url": x}
+        elif isinstance(x, (list, tuple)):
+            x = {"url": x[0], "output": x[1]}
+        ent.update(x)
+        if ent.get("output") is None and outdir is None:
+            raise Exception("please set output: %s" % (x))
+        res.append(ent)
+    # files are written concurrently: each item needs its own output
+    used = set()
+    for ent in res:
+        if ent.get("output") is None:
+            continue
+        out = os.path.normpath(ent["output"])
+        if out in used:
+            raise Exception("duplicate output: %s" % (ent["output"]))
+        used.add(out)
+    for ent in res:
+        if ent.get("output") is not None:
+            continue
+        name = os.path.basename(urllib.parse.urlparse(ent["url"]).path) or "index.html"
+        base, ext = os.path.splitext(name)
+        out = os.path.join(outdir, name)
+        i = 0
+        while os.path.normpath(out) in used:
+            i += 1
+            out = os.path.join(outdir, "%s_%d%s" % (base, i, ext))
+        used.add(os.path.normpath(out))
+        ent["output"] = out
+    return res
+
+
+def bulk_download(self, param):
+    items = download_items(self, param)
+    workers = param.get("workers", 4)
+    per_host = param.get("per_host", 2)
+    sess = self.sync_cookies(browser_cookies(self), workers)
+    if param.get("output") is not None:
+        os.makedirs(param.get("output"), exist_ok=True)
+    # one metadata db for all items. not opened in worker threads
+    cache = None
+    for ent in items:
+        if ent.get("cache", False):
+            cache = get_httpcache(self, ent["cache"])
+            break
+
+    def fetch(ent):
+        res = {"url": ent["url"], "output": ent["output"], "status": None, "size": 0, "error": None}
+        start = time.time()
+        try:
+            res["status"], res["size"] = download_file(
+                self, sess, ent["url"], ent["output"], ent.get("method", "get"), ent.get("query"),
+                ent.get("headers"), ent.get("timeout"), ent.get("resume", False), ent.get("chunk", 1024 * 1024),
+                cache if ent.get("cache", False) else None)
+        except Exception as e:
+            self.log.warning("download %s: %s", ent["url"], e)
+            res["error"] = str(e)
+        res["elapsed"] = time.time() - start
+        return res
+    # queue for each host. a worker is given an item only when its host has a free slot
+    hosts = {}
+    for i, ent in enumerate(items):
+        hosts.setdefault(urllib.parse.urlparse(ent["url"]).netloc, collections.deque()).append(i)
+    active = {k: 0 for k in hosts}
+    running = {}
+    res = [None] * len(items)
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+        while True:
+            for host, q in hosts.items():
+                while len(q) != 0 and active[host] < per_host and len(running) < workers:
+                    i = q.popleft()
+                    active[host] += 1
+                    running[ex.submit(fetch, items[i])] = (i, host)
+            if len(running) == 0:
+                break
+            done, _ = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                i, host = running.pop(fut)
+                active[host] -= 1
+                res[i] = fut.result()
+    self.log.info("download %d files(%d errors): %d bytes, %.3f sec", len(res),
+                  len([x for x in res if x["error"] is not None or x["status"] >= 400]),
+                  sum([x["size"] for x in res]), time.time() - start)
+    return res
+
+
 def Base_download(self, param):
     """
     - name: download file using python-requests
@@ -373,8 +640,33 @@ def Base_download(self, param):
           var1: val1
         timeout: 10
         json: false
-        output: outfile.txt
+    - name: download large file (returns output filename)
+      download:
+        url: "{{current_url}}/file2"
+        output: outfile.bin
+        resume: true   # continue partial file using Range request
+        chunk: 1048576
+    - name: download only when modified (ETag/Last-Modified)
+      download:
+        url: "{{current_url}}/report.csv"
+        output: report.csv
+        cache: true   # or filename of metadata db. default: $XDG_CACHE_HOME/selenible/download.db
+    - name: download many files concurrently (returns status of each)
+      download:
+        items:
+          - url: "{{current_url}}/file3"
+            output: file3.bin
+          - "{{current_url}}/file4"   # saved in output directory
+        output: assets/
+        workers: 8
+        per_host: 2
+    - name: download list of urls in variable
+      download:
+        items: urls
+        output: assets/
     """
+    if param.get("items") is not None:
+        return bulk_download(self, param)
     url = param.get("url", None)
     if url is None:
         raise Exception("url mut set: %s" % (param))
@@ -382,23 +674,25 @@ def Base_download(self, param):
     self.log.debug("URL parsed: %s", parsed_url)
     method = param.get("method", "get")
     query = param.get("query", None)
-    cookies = self.driver.get_cookies()
     headers = param.get("headers", None)
     timeout = param.get("timeout", None)
     is_json = param.get("json", False)
-    sess = requests.Session()
+    sess = self.sync_cookies(browser_cookies(self))
     output = param.get("output", None)
-    for ck in cookies:
-        sess.cookies.set(ck.get("name"), ck.get("value"),
-                         path=ck.get("path", "/"), domain=ck.get("domain", ""),
-                         secure=ck.get("secure", False))
-    resp = sess.request(method, url, params=query, headers=headers, timeout=timeout)
-    if output is not None:
-        with open(output, "wb") as f:
-            f.write(resp.content)
+    if output is None:
+        resp = sess.request(method, url, params=query, headers=headers, timeout=timeout)
+        if is_json:
+            return resp.json()
+        return resp.text
+    cache = get_httpcache(self, param.get("cache")) if param.get("cache", False) else None
+    status, _ = download_file(self, sess, url, output, method, query, headers, timeout,
+                              param.get("resume", False), param.get("chunk", 1024 * 1024), cache)
+    if status >= 400 and not (status == 416 and param.get("resume", False)):
+        raise Exception("download failed: %s status %d" % (url, status))
     if is_json:
-        return resp.json()
-    return resp.text
+        with open(output) as f:
+            return json.load(f)
+    return output
 
 
 set_schema = yaml.safe_load("""
@@ -428,4 +722,9 @@ def Base_set(self, param):
     res = self.getvalue(param)
     if res is not None:
         return self.return_element(param, res)
+    tree = self.snapshot_tree()
+    if tree is not None and param.get("parseHTML", False):
+        res = self.findlocal(tree, param)
+        if res is not None:
+            return res
     return self.return_element(param, self.findmany(param))
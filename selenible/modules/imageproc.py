@@ -1,12 +1,559 @@
+import io
 import os
+import sys
+import glob
 import time
 import math
 import yaml
 import tarfile
+import queue
+import struct
+import zlib
+import hashlib
 import zipfile
+import subprocess
+import threading
+import functools
+import concurrent.futures
+import numpy
+from logging import getLogger
 from PIL import Image, ImageChops, ImageFilter, ImageEnhance, ImageFont, ImageDraw, ImageColor, ImageOps
 
 
+def bands(img, height=256):
+    """yield (y, array) of horizontal bands. only one band is converted at a time"""
+    for y in range(0, img.height, height):
+        yield y, numpy.asarray(img.crop((0, y, img.width, min(img.height, y + height))))
+
+
+def absdiff(a, b):
+    """|a - b| without overflow and without wider intermediate"""
+    return numpy.maximum(a, b) - numpy.minimum(a, b)
+
+
+def diff_bands(img1, img2, band=64):
+    """yield (y, |img1 - img2|) band by band. images should have same size and mode"""
+    if img1.size != img2.size:
+        raise Exception("size mismatch: %s != %s" % (img1.size, img2.size))
+    if img1.mode != img2.mode:
+        img2 = img2.convert(img1.mode)
+    for (y, a), (_, b) in zip(bands(img1, band), bands(img2, band)):
+        yield y, absdiff(a, b)
+
+
+def autocrop_box(img, tolerance=100, band=64):
+    """bounding box of pixels differ from top-left (background) pixel more than tolerance"""
+    if img.mode not in ("L", "LA", "RGB", "RGBA"):
+        img = img.convert("RGBA")
+    nch = len(img.getbands())
+    rows = numpy.zeros(img.height, dtype=bool)
+    cols = numpy.zeros(img.width * nch, dtype=bool)
+    lo = hi = None
+    for y, a in bands(img, band):
+        # (rows, width * channels) view: reductions run on contiguous memory
+        a = a.reshape(a.shape[0], -1)
+        if lo is None:
+            bg = a[0, :nch].astype(numpy.int16)
+            lo = numpy.tile(numpy.clip(bg - tolerance, 0, 255).astype(numpy.uint8), img.width)
+            hi = numpy.tile(numpy.clip(bg + tolerance, 0, 255).astype(numpy.uint8), img.width)
+        d = numpy.less(a, lo)
+        d |= numpy.greater(a, hi)
+        r = d.any(axis=1)
+        rows[y:y + d.shape[0]] = r
+        if r.any():
+            cols |= d.any(axis=0)
+    if not rows.any():
+        return None
+    ys = numpy.flatnonzero(rows)
+    xs = numpy.flatnonzero(cols.reshape(img.width, nch).any(axis=1))
+    return (int(xs[0]), int(ys[0]), int(xs[-1]) + 1, int(ys[-1]) + 1)
+
+
+def crop_image(img, size, tolerance=100):
+    if size == "auto":
+        box = autocrop_box(img, tolerance)
+        return img.crop(box)
+    elif isinstance(size, (tuple, list)):
+        return img.crop(size)
+    raise Exception("not implemented yet: crop %s" % (size,))
+
+
+def resize_image(img, size=None, percent=None, algorithm="NEAREST"):
+    if size is None:
+        if percent is None:
+            raise Exception("missing size: [width, height]")
+        if isinstance(percent, (tuple, list)):
+            pctX = percent[0]
+            pctY = percent[1]
+        else:
+            pctX = pctY = float(percent)
+        size = (int(img.width * pctX / 100), int(img.height * pctY / 100))
+    if not hasattr(Image, algorithm):
+        raise Exception("algorighm not found: %s" % (algorithm))
+    return img.resize(tuple(size), getattr(Image, algorithm))
+
+
+def image_hash(img, size=8):
+    """difference hash of downsampled grayscale image (size*size bits)"""
+    small = img.convert("L").resize((size + 1, size), Image.BILINEAR)
+    a = numpy.asarray(small, dtype=numpy.int16)
+    bits = numpy.packbits((a[:, 1:] > a[:, :-1]).flatten())
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def hash_distance(h1, h2):
+    """
+    >>> hash_distance(0b1011, 0b0001)
+    2
+    """
+    return bin(h1 ^ h2).count("1")
+
+
+def encode_image(img, filename):
+    """encode image to bytes. format is decided by the extension of filename"""
+    ext = os.path.splitext(filename)[1].lower()
+    fmt = Image.registered_extensions().get(ext, "PNG")
+    buf = io.BytesIO()
+    img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+tar_modes = {
+    ".tar": "a",
+    ".tar.gz": "w:gz",
+    ".tgz": "w:gz",
+    ".tar.bz2": "w:bz2",
+    ".tbz2": "w:bz2",
+    ".tar.xz": "w:xz",
+    ".txz": "w:xz",
+}
+
+
+def entry_name(filename):
+    """name in archive. same as zipfile/tarfile do for files (drive and leading / are removed)
+
+    >>> entry_name("/tmp/x/a.png")
+    'tmp/x/a.png'
+    """
+    name = os.path.normpath(os.path.splitdrive(filename)[1]).replace(os.sep, "/")
+    return name.lstrip("/")
+
+
+class archivewriter(threading.Thread):
+    """keep zip/tar archive open and write entries in background"""
+
+    def __init__(self, filename, level=None, queuesize=64):
+        super().__init__()
+        self.filename = filename
+        self.log = getLogger(self.__class__.__name__)
+        self.queue = queue.Queue(queuesize)
+        self.count = 0
+        self.errors = []
+        self.reported = 0
+        lower = filename.lower()
+        if lower.endswith((".zip", ".cbz")):
+            if level is None:
+                self.zf = zipfile.ZipFile(filename, 'a')
+            elif sys.version_info < (3, 7):
+                # no compresslevel
+                self.zf = zipfile.ZipFile(filename, 'a', zipfile.ZIP_DEFLATED)
+            else:
+                self.zf = zipfile.ZipFile(filename, 'a', zipfile.ZIP_DEFLATED, compresslevel=level)
+            self.tf = None
+        else:
+            mode = [(k, v) for k, v in tar_modes.items() if lower.endswith(k)]
+            if len(mode) == 0:
+                raise Exception("not implemented yet: archive %s" % (filename,))
+            ext, mode = mode[-1]
+            if mode != "a" and os.path.exists(filename):
+                # cannot append to compressed tar: keep previous one
+                base = filename[:-len(ext)]
+                i = 1
+                while os.path.exists("%s.%d%s" % (base, i, filename[-len(ext):])):
+                    i += 1
+                filename = "%s.%d%s" % (base, i, filename[-len(ext):])
+                self.log.warning("cannot append to compressed tar. write to %s", filename)
+                self.filename = filename
+            kwargs = {}
+            if level is not None:
+                kwargs["preset" if mode == "w:xz" else "compresslevel"] = level
+            self.tf = tarfile.open(filename, mode, **kwargs)
+            self.zf = None
+        self.daemon = True
+        self.start()
+
+    def add(self, arcname, data=None, delete=False):
+        """add file (or bytes, if data is set)"""
+        if not self.is_alive():
+            raise Exception("archive already closed: %s" % (self.filename))
+        self.check()
+        self.queue.put((arcname, data, delete))
+
+    def check(self):
+        """raise if entries failed in background since last check"""
+        if len(self.errors) > self.reported:
+            errs = self.errors[self.reported:]
+            self.reported = len(self.errors)
+            raise Exception("archive %s: %d entries failed: %s" % (
+                self.filename, len(errs), ", ".join(["%s(%s)" % x for x in errs])))
+
+    def write1(self, arcname, data):
+        if self.zf is not None:
+            if data is None:
+                self.zf.write(arcname)
+            else:
+                self.zf.writestr(entry_name(arcname), data)
+        elif data is None:
+            self.tf.add(arcname)
+        else:
+            ti = tarfile.TarInfo(entry_name(arcname))
+            ti.size = len(data)
+            ti.mtime = time.time()
+            self.tf.addfile(ti, io.BytesIO(data))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            arcname, data, delete = item
+            try:
+                self.write1(arcname, data)
+                self.count += 1
+                if delete:
+                    os.unlink(arcname)
+            except Exception as e:
+                self.log.error("archive %s %s: %s", self.filename, arcname, e)
+                self.errors.append((arcname, str(e)))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.zf is not None:
+            self.zf.close()
+        else:
+            self.tf.close()
+        self.log.info("%s: %d files, %d errors", self.filename, self.count, len(self.errors))
+        self.check()
+
+
+def get_archive(self, filename, level=None):
+    """archive writer shared during the run. closed by finish()"""
+    if filename not in self.archives:
+        self.log.debug("open archive %s", filename)
+        self.archives[filename] = archivewriter(filename, level)
+        self.add_finalizer(functools.partial(close_archive, self, filename))
+    return self.archives[filename]
+
+
+def close_archive(self, filename):
+    arc = self.archives.pop(filename, None)
+    if arc is not None:
+        arc.close()
+
+
+png_signature = b"\x89PNG\r\n\x1a\n"
+# colortype -> (channels, mode)
+png_colortypes = {0: (1, "L"), 2: (3, "RGB"), 3: (1, "P"), 4: (2, "LA"), 6: (4, "RGBA")}
+
+
+def png_chunk(ctype, data):
+    return struct.pack(">I", len(data)) + ctype + data + struct.pack(">I", zlib.crc32(ctype + data))
+
+
+class pngreader:
+    """read non-interlaced 8bit png in horizontal bands, without decoding whole image"""
+
+    def __init__(self, filename):
+        self.f = open(filename, "rb")
+        try:
+            if self.f.read(8) != png_signature:
+                raise Exception("not png: %s" % (filename))
+            ctype, ihdr = self.chunk()
+            if ctype != b"IHDR":
+                raise Exception("broken png: %s" % (filename))
+            self.width, self.height, depth, colortype, _, _, interlace = struct.unpack(">IIBBBBB", ihdr)
+            if depth != 8 or interlace != 0 or colortype not in png_colortypes:
+                raise Exception("cannot stream png(depth=%d, colortype=%d, interlace=%d): %s" % (
+                    depth, colortype, interlace, filename))
+        except Exception:
+            self.f.close()
+            raise
+        self.ihdr = ihdr
+        channels, self.mode = png_colortypes[colortype]
+        self.stride = self.width * channels
+        # chunks needed to decode the band (palette, transparency)
+        self.extra = []
+        self.idat = b""
+        while True:
+            ctype, data = self.chunk()
+            if ctype == b"IDAT":
+                self.idat = data
+                break
+            if ctype in (b"PLTE", b"tRNS"):
+                self.extra.append((ctype, data))
+            if ctype == b"IEND":
+                break
+        self.zobj = zlib.decompressobj()
+        self.buf = bytearray()
+        self.prev = None
+        self.y = 0
+
+    def chunk(self):
+        hdr = self.f.read(8)
+        if len(hdr) != 8:
+            return b"IEND", b""
+        length, ctype = struct.unpack(">I4s", hdr)
+        data = self.f.read(length)
+        self.f.read(4)  # crc
+        return ctype, data
+
+    def rawrows(self, nrows):
+        """filtered rows (filter type byte + row) of nrows"""
+        need = nrows * (self.stride + 1)
+        while len(self.buf) < need:
+            data = self.zobj.unconsumed_tail
+            if len(data) == 0:
+                data, self.idat = self.idat, b""
+            if len(data) == 0:
+                ctype, data = self.chunk()
+                if ctype != b"IDAT":
+                    raise Exception("truncated png: %d rows missing" % (self.height - self.y))
+            # max_length: highly compressed image should not expand at once
+            self.buf += self.zobj.decompress(data, need - len(self.buf))
+        res = bytes(self.buf[:need])
+        del self.buf[:need]
+        return res
+
+    def band(self, height):
+        height = min(height, self.height - self.y)
+        if height <= 0:
+            return None
+        raw = self.rawrows(height)
+        nrows = height
+        if self.prev is not None:
+            # filters refer the previous row. prepend it as unfiltered row and let Pillow decode
+            raw = b"\x00" + self.prev + raw
+            nrows += 1
+        ihdr = struct.pack(">II", self.width, nrows) + self.ihdr[8:]
+        mini = [png_signature, png_chunk(b"IHDR", ihdr)]
+        mini.extend([png_chunk(k, v) for k, v in self.extra])
+        mini.append(png_chunk(b"IDAT", zlib.compress(raw, 0)))
+        mini.append(png_chunk(b"IEND", b""))
+        img = Image.open(io.BytesIO(b"".join(mini)))
+        img.load()
+        if nrows != height:
+            img = img.crop((0, 1, self.width, nrows))
+        self.prev = img.crop((0, height - 1, self.width, height)).tobytes()
+        self.y += height
+        return img
+
+    def bands(self, height):
+        try:
+            while True:
+                img = self.band(height)
+                if img is None:
+                    break
+                yield img
+        finally:
+            self.f.close()
+
+
+class pngwriter:
+    """write png from horizontal bands. rows are encoded with Up filter"""
+    colortypes = {"L": 0, "RGB": 2, "LA": 4, "RGBA": 6}
+
+    def __init__(self, filename, width, height, mode, level=6):
+        if mode not in self.colortypes:
+            raise Exception("cannot write %s image in bands" % (mode))
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.stride = width * len(mode)
+        self.f = open(filename, "wb")
+        self.f.write(png_signature)
+        self.f.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, self.colortypes[mode], 0, 0, 0)))
+        self.zobj = zlib.compressobj(level)
+        self.prev = numpy.zeros(self.stride, dtype=numpy.uint8)
+        self.y = 0
+
+    def write(self, img):
+        if img.mode != self.mode:
+            img = img.convert(self.mode)
+        rows = numpy.frombuffer(img.tobytes(), dtype=numpy.uint8).reshape(img.height, self.stride)
+        up = numpy.empty((img.height, self.stride + 1), dtype=numpy.uint8)
+        up[:, 0] = 2
+        up[0, 1:] = rows[0] - self.prev
+        up[1:, 1:] = rows[1:] - rows[:-1]
+        self.prev = rows[-1].copy()
+        self.idat(self.zobj.compress(up))
+        self.y += img.height
+
+    def idat(self, data):
+        if len(data) != 0:
+            self.f.write(png_chunk(b"IDAT", data))
+
+    def close(self):
+        self.idat(self.zobj.flush())
+        self.f.write(png_chunk(b"IEND", b""))
+        self.f.close()
+        if self.y != self.height:
+            raise Exception("png rows mismatch: %d != %d" % (self.y, self.height))
+
+
+def image_info(filename):
+    """(width, height, mode) without decoding"""
+    try:
+        rd = pngreader(filename)
+        rd.f.close()
+        return rd.width, rd.height, rd.mode
+    except Exception:
+        img = Image.open(filename)
+        return img.width, img.height, img.mode
+
+
+def open_bands(filename, height):
+    """returns (width, height, mode, iterator of bands)"""
+    try:
+        rd = pngreader(filename)
+        return rd.width, rd.height, rd.mode, rd.bands(height)
+    except Exception as e:
+        log = getLogger("open_bands")
+        log.debug("fallback to crop: %s", e)
+    img = Image.open(filename)
+    return img.width, img.height, img.mode, (
+        img.crop((0, y, img.width, min(y + height, img.height))) for y in range(0, img.height, height))
+
+
+def vstack(imgs):
+    if len(imgs) == 1:
+        return imgs[0]
+    res = Image.new(imgs[0].mode, (imgs[0].width, sum([x.height for x in imgs])))
+    y = 0
+    for img in imgs:
+        res.paste(img, (0, y))
+        y += img.height
+    return res
+
+
+def tiled_map(bands, fn, margin):
+    """apply fn to each band with margin rows of neighbour bands"""
+    prev = None
+    cur = next(bands, None)
+    while cur is not None:
+        nxt = next(bands, None)
+        parts = [cur]
+        top = 0
+        if margin != 0 and prev is not None:
+            parts.insert(0, prev.crop((0, prev.height - margin, prev.width, prev.height)))
+            top = margin
+        if margin != 0 and nxt is not None:
+            parts.append(nxt.crop((0, 0, nxt.width, min(margin, nxt.height))))
+        res = fn(vstack(parts))
+        yield res.crop((0, top, res.width, top + cur.height))
+        prev, cur = cur, nxt
+
+
+def parse_size(v):
+    """
+    >>> parse_size("64M")
+    67108864
+    >>> parse_size(1000)
+    1000
+    """
+    if isinstance(v, int):
+        return v
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    v = str(v).strip().upper().rstrip("B")
+    if v[-1:] in units:
+        return int(float(v[:-1]) * units[v[-1]])
+    return int(v)
+
+
+def band_height(width, mode, margin, param):
+    """band height from 'tiled' or 'memory' parameter"""
+    tiled = param.get("tiled")
+    if param.get("memory") is not None:
+        # prev/cur/next bands, stacked copy, filter temporaries, decoder and encoder buffers (measured)
+        rowsize = width * max(len(mode), 1) * 16
+        height = parse_size(param.get("memory")) // rowsize - 2 * margin
+    elif isinstance(tiled, int) and not isinstance(tiled, bool):
+        height = tiled
+    else:
+        height = 256
+    if height < max(margin, 1):
+        raise Exception("memory too small for tiled processing: band=%d, margin=%d" % (height, margin))
+    return height
+
+
+def is_tiled(param):
+    return param.get("tiled", False) or param.get("memory") is not None
+
+
+def tiled_process(self, param, fn, margin, others=()):
+    """process input in horizontal bands and write png. others are read in same bands for fn"""
+    input_filename, filename = inout_fname(param)
+    if os.path.splitext(filename)[1].lower() != ".png":
+        raise Exception("tiled processing writes png only: %s" % (filename))
+    width, height, mode = image_info(input_filename)
+    bandh = band_height(width, mode, margin, param)
+    self.log.info("tiled %s(%dx%d) -> %s: band=%d, margin=%d", input_filename, width, height, filename,
+                  bandh, margin)
+    bands = open_bands(input_filename, bandh)[3]
+    if len(others) != 0:
+        srcs = [bands] + [open_bands(x, bandh)[3] for x in others]
+        results = (fn(*x) for x in zip(*srcs))
+    else:
+        results = tiled_map(bands, fn, margin)
+    tmpfn = filename + ".tmp"
+    wr = None
+    try:
+        for res in results:
+            if wr is None:
+                wr = pngwriter(tmpfn, width, height, res.mode if res.mode in pngwriter.colortypes else "RGBA")
+            wr.write(res)
+        wr.close()
+        os.replace(tmpfn, filename)
+    finally:
+        if os.path.exists(tmpfn):
+            os.unlink(tmpfn)
+
+
+# default argument (radius or size) of filters when null is given
+filter_defaults = {"GaussianBlur": 2, "UnsharpMask": 2, "ModeFilter": 3, "MedianFilter": 3,
+                   "MinFilter": 3, "MaxFilter": 3}
+
+
+def filter_margin(name, v):
+    """rows of neighbours needed by the filter. raise if not tile-safe"""
+    if isinstance(v, (list, tuple)):
+        arg = v[0] if len(v) != 0 else None
+    elif isinstance(v, dict):
+        arg = v.get("radius", v.get("size"))
+    else:
+        arg = v
+    if arg is None:
+        arg = filter_defaults.get(name)
+    if name in ("GaussianBlur", "BoxBlur", "UnsharpMask"):
+        return int(math.ceil(3 * arg)) + 1
+    if name in ("ModeFilter", "MedianFilter", "MinFilter", "MaxFilter", "RankFilter"):
+        return arg // 2
+    if v is None:
+        # builtin kernels are 3x3 or 5x5
+        return 2
+    raise Exception("filter %s is not tile-safe" % (name))
+
+
+# enhancer -> margin. Contrast uses mean of whole image
+enhance_margins = {"Brightness": 0, "Color": 0, "Sharpness": 1}
+
+
+def enhance_margin(name):
+    if name not in enhance_margins:
+        raise Exception("enhance %s is not tile-safe" % (name))
+    return enhance_margins[name]
+
+
 def inout_fname(param):
     input_filename = param.get("input")
     output_filename = param.get("output", input_filename)
@@ -28,6 +575,7 @@ allOf:
             items: {type: integer}
             minItems: 4
             maxItems: 4
+      tolerance: {type: integer}
 """)
 
 
@@ -37,6 +585,7 @@ def Base_image_crop(self, param):
       image_crop:
         input: filename.png
         size: auto
+        tolerance: 100   # max difference from background color
     - name: crop local image (manual)
       image_crop:
         input: filename.png
@@ -52,22 +601,193 @@ def Base_image_crop(self, param):
         filename += "_%03d.png" % (msec)
         self.log.debug("filename generated %s", filename)
     size = param.get("size", "auto")
-    if size == "auto":
-        img = Image.open(input_filename)
-        bg = Image.new(img.mode, img.size, img.getpixel((0, 0)))
-        diff = ImageChops.difference(img, bg)
-        diff = ImageChops.add(diff, diff, 2.0, -100)
-        box = diff.getbbox()
-        self.log.info("auto crop: %s", box)
-        crop = img.crop(box)
-        crop.save(filename)
-    elif isinstance(size, (tuple, list)):
-        img = Image.open(input_filename)
-        self.log.info("manual crop: %s", size)
-        crop = img.crop(size)
-        crop.save(filename)
+    img = Image.open(input_filename)
+    crop = crop_image(img, size, param.get("tolerance", 100))
+    self.log.info("crop: %s -> %s", size, crop.size)
+    crop.save(filename)
+
+
+def pillow_optimize(input_filename, filename):
+    """fallback when optimizer command is not installed"""
+    img = Image.open(input_filename)
+    img.load()
+    buf = io.BytesIO()
+    img.save(buf, img.format, optimize=True, compress_level=9)
+    if buf.tell() < os.stat(input_filename).st_size:
+        with open(filename, "wb") as f:
+            f.write(buf.getvalue())
+    elif filename != input_filename:
+        os.rename(input_filename, filename)
+
+
+class optcache:
+    """content addressed cache of optimized images. least recently used files are evicted"""
+
+    def __init__(self, path=None, maxsize=100 * 1024 * 1024):
+        if path is None or path is True:
+            base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+            path = os.path.join(base, "selenible", "optimize")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.maxsize = maxsize
+
+    def key(self, data, command, level):
+        h = hashlib.sha256(data)
+        h.update(("\0%s\0%s" % (command, level)).encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key):
+        fn = os.path.join(self.path, key)
+        try:
+            with open(fn, "rb") as f:
+                data = f.read()
+            os.utime(fn)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        fn = os.path.join(self.path, key)
+        tmpfn = "%s.%d.tmp" % (fn, os.getpid())
+        with open(tmpfn, "wb") as f:
+            f.write(data)
+        os.replace(tmpfn, fn)
+        self.evict()
+
+    def evict(self):
+        ents = []
+        for ent in os.scandir(self.path):
+            try:
+                st = ent.stat()
+            except FileNotFoundError:
+                continue
+            ents.append((st.st_mtime, st.st_size, ent.path))
+        total = sum([x[1] for x in ents])
+        for _, size, fn in sorted(ents):
+            if total <= self.maxsize:
+                break
+            try:
+                os.unlink(fn)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def optimize_file(input_filename, filename, command="optipng", level=9, cache=None):
+    """optimize one file. runs in worker process"""
+    with open(input_filename, "rb") as f:
+        data = f.read()
+    before = len(data)
+    if before == 0:
+        raise Exception("image size is zero: %s" % (input_filename))
+    res = {"input": input_filename, "output": filename, "method": command, "before": before, "cache": None}
+    if cache is not None:
+        key = cache.key(data, command, level)
+        optimized = cache.get(key)
+        if optimized is not None:
+            with open(filename, "wb") as f:
+                f.write(optimized)
+            res.update(method="cache", cache="hit", after=len(optimized))
+            return res
+        res["cache"] = "miss"
+    if filename != input_filename:
+        cmd = [command, "-o%d" % (level), "-out", filename, input_filename]
     else:
-        raise Exception("not implemented yet: crop %s %s" % (filename, size))
+        cmd = [command, "-o%d" % (level), filename]
+    try:
+        subprocess.check_output(cmd, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        res["method"] = "pillow"
+        pillow_optimize(input_filename, filename)
+    if cache is not None:
+        with open(filename, "rb") as f:
+            cache.put(key, f.read())
+    res["after"] = os.stat(filename).st_size
+    return res
+
+
+class optimizepool:
+    """bounded process pool to optimize images while the playbook goes on"""
+
+    def __init__(self, drvobj, workers=None, queuesize=16):
+        self.drvobj = drvobj
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers)
+        self.sem = threading.BoundedSemaphore(queuesize)
+        # number of files submitted and not yet finished (including done callback)
+        self.pending = 0
+        self.cond = threading.Condition()
+
+    def submit(self, input_filename, filename, command="optipng", level=9, cache=None, archive=None):
+        self.sem.acquire()
+        with self.cond:
+            self.pending += 1
+        try:
+            fut = self.pool.submit(optimize_file, input_filename, filename, command, level, cache)
+        except Exception:
+            self.finished()
+            raise
+        fut.add_done_callback(functools.partial(self.done, archive))
+        return fut
+
+    def finished(self):
+        self.sem.release()
+        with self.cond:
+            self.pending -= 1
+            self.cond.notify_all()
+
+    def done(self, archive, fut):
+        try:
+            res = fut.result()
+        except Exception as e:
+            self.drvobj.log.error("optimize failed: %s", e)
+            self.drvobj.add_summary("image_optimize", error=1)
+            self.finished()
+            return
+        try:
+            optimize_stat(self.drvobj, res)
+            if archive is not None:
+                archive.add(res["output"], delete=True)
+        except Exception as e:
+            # callback: nobody catches this
+            self.drvobj.log.error("optimize %s: %s", res["output"], e)
+            self.drvobj.add_summary("image_optimize", error=1)
+        finally:
+            self.finished()
+
+    def wait(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending == 0)
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown()
+
+
+def optimize_stat(self, res):
+    before, after = res["before"], res["after"]
+    self.log.info("%s(%s): before=%d, after=%d, reduce %d bytes (%.1f %%)", res["output"], res["method"],
+                  before, after, before - after, 100.0 * (before - after) / before)
+    self.add_summary("image_optimize", files=1, before=before, after=after)
+    if res["cache"] is not None:
+        self.add_summary("image_optimize", **{"cache_" + res["cache"]: 1})
+        with self.summary_lock:
+            ent = self.summary["image_optimize"]
+            hit = ent.get("cache_hit", 0)
+            ent["hit_rate"] = hit / (hit + ent.get("cache_miss", 0))
+
+
+def get_optimizer(self, workers=None, queuesize=16):
+    if getattr(self, "optimizer", None) is None:
+        self.optimizer = optimizepool(self, workers, queuesize)
+        self.add_barrier(functools.partial(close_optimizer, self))
+    return self.optimizer
+
+
+def close_optimizer(self):
+    opt = getattr(self, "optimizer", None)
+    if opt is not None:
+        self.optimizer = None
+        opt.shutdown()
 
 
 image_optimize_schema = yaml.safe_load("""
@@ -76,6 +796,15 @@ allOf:
   - type: object
     properties:
       command: {type: string}
+      level: {type: integer}
+      cache:
+        oneOf:
+          - type: boolean
+          - type: string
+      cache_size: {type: integer}
+      background: {type: boolean}
+      workers: {type: integer}
+      queue: {type: integer}
 """)
 
 
@@ -84,28 +813,52 @@ def Base_image_optimize(self, param):
     - name: optimize local png using optipng
       image_optimize:
         input: filename.png
+    - name: optimize in background process
+      image_optimize:
+        input: filename.png
+        background: true
+        workers: 4
+    - name: reuse optimized result of identical image
+      image_optimize:
+        input: filename.png
+        level: 7
+        cache: true   # or directory. default: $XDG_CACHE_HOME/selenible/optimize
+        cache_size: 104857600
+    - name: wait for background optimization
+      image_wait: {}
     """
     input_filename, filename = inout_fname(param)
     command = param.get("command", "optipng")
+    level = param.get("level", 9)
+    cache = None
+    if param.get("cache", False):
+        cache = optcache(param.get("cache"), param.get("cache_size", 100 * 1024 * 1024))
     self.log.info("optimize image: %s -> %s", input_filename, filename)
-    before = os.stat(input_filename)
-    if before.st_size == 0:
-        raise Exception("image size is zero: %s" % (input_filename))
-    if filename != input_filename:
-        cmd = [command, "-o9", "-out", filename, input_filename]
-    else:
-        cmd = [command, "-o9", filename]
-    try:
-        sout = self.runcmd(cmd)
-        self.log.debug("result: %s", sout)
-        after = os.stat(filename)
-        self.log.info("%s: before=%d, after=%d, reduce %d bytes (%.1f %%)", filename,
-                      before.st_size, after.st_size, before.st_size - after.st_size,
-                      100.0 * (before.st_size - after.st_size) / before.st_size)
-    except FileNotFoundError as e:
-        self.log.info("cannot exec %s: %s", cmd, e)
-        if filename != input_filename:
-            os.rename(input_filename, filename)
+    if param.get("background", False):
+        opt = get_optimizer(self, param.get("workers"), param.get("queue", 16))
+        opt.submit(input_filename, filename, command, level, cache)
+        return filename
+    res = optimize_file(input_filename, filename, command, level, cache)
+    optimize_stat(self, res)
+    return res
+
+
+image_wait_schema = yaml.safe_load("""
+oneOf:
+  - type: "null"
+  - type: object
+""")
+
+
+def Base_image_wait(self, param):
+    """
+    - name: wait for background optimization
+      image_wait: {}
+    """
+    opt = getattr(self, "optimizer", None)
+    if opt is not None:
+        opt.wait()
+    return self.summary.get("image_optimize", {})
 
 
 image_resize_schema = yaml.safe_load("""
@@ -142,74 +895,113 @@ def Base_image_resize(self, param):
     input_filename, filename = inout_fname(param)
     self.log.info("resize image: %s %s -> %s", input_filename, param, filename)
     img = Image.open(input_filename)
-    size = param.get("size")
-    if size is None:
-        pct = param.get("percent")
-        if pct is None:
-            raise Exception("missing size: [width, height]")
-        if isinstance(pct, (tuple, list)):
-            pctX = pct[0]
-            pctY = pct[1]
-        else:
-            pctX = pctY = float(pct)
-        size = (int(img.width * pctX / 100), int(img.height * pctY / 100))
-    algostr = param.get("algorithm", "NEAREST")
-    if not hasattr(Image, algostr):
-        raise Exception("algorighm not found: %s" % (algostr))
-    rst = img.resize(tuple(size), getattr(Image, algostr))
+    rst = resize_image(img, param.get("size"), param.get("percent"), param.get("algorithm", "NEAREST"))
     rst.save(filename)
 
 
+@functools.lru_cache(maxsize=64)
+def load_font(path=None, size=10, index=0):
+    """font objects are shared in the process"""
+    if path is None:
+        return ImageFont.load_default()
+    return ImageFont.truetype(path, size=size, index=index)
+
+
+text_keys = ("position", "font", "size", "index", "color")
+# keys to get text. see Base.getvalue
+text_sources = ("text", "password", "pipe", "yaml", "json", "toml")
+
+
+def text_items(param):
+    """expand items. each item inherits text parameters from param"""
+    base = {k: param[k] for k in text_keys + text_sources if k in param}
+    if "items" not in param:
+        return [base]
+    res = []
+    for x in param.get("items"):
+        if isinstance(x, dict) and not any([k in x for k in text_sources]):
+            ent = dict(base)
+        else:
+            ent = {k: v for k, v in base.items() if k not in text_sources}
+        if isinstance(x, dict):
+            ent.update(x)
+        else:
+            ent["text"] = x
+        res.append(ent)
+    return res
+
+
+def writetext_image(img, items):
+    draw = ImageDraw.Draw(img)
+    for item in items:
+        font = load_font(item.get("font"), item.get("size", 10), item.get("index", 0))
+        fillcolor = ImageColor.getcolor(item.get("color", "red"), img.mode)
+        draw.text(tuple(item.get("position", (0, 0))), item.get("text"), fill=fillcolor, font=font)
+    del draw
+    return img
+
+
+image_writetext_schema = yaml.safe_load("""
+allOf:
+  - "$ref": "#/definitions/common/inout"
+  - type: object
+    properties:
+      text: {type: string}
+      font: {type: string}
+      size: {type: integer}
+      index: {type: integer}
+      color: {type: string}
+      position:
+        type: array
+        items: {type: integer}
+      items:
+        type: array
+        items:
+          oneOf:
+            - type: string
+            - type: object
+""")
+
+
 def Base_image_writetext(self, param):
     """
     - name: write text to local image
       image_writetext:
         input: filename.png
         font: /path/to/file.ttc
+        index: 0   # font index in .ttc
         text: hello world
         color: blue
         position: [100, 200]   # x, y
+    - name: write many texts at once
+      image_writetext:
+        input: filename.png
+        font: /path/to/file.ttc
+        size: 16
+        items:
+          - text: "{{step_name}}"
+            position: [10, 10]
+          - text: "{{timestamp}}"
+            position: [10, 30]
+            color: gray
     """
-    text = self.getvalue(param)
+    items = text_items(param)
+    for item in items:
+        item["text"] = self.getvalue(item)
     input_filename, filename = inout_fname(param)
-    pos = param.get("position", (0, 0))
-    fontname = param.get("font")
-    fontsize = param.get("size", 10)
-    color = param.get("color", "red")
-    if fontname is None:
-        font = ImageFont.load_default()
-    else:
-        font = ImageFont.truetype(fontname, size=fontsize)
     img = Image.open(input_filename)
-    draw = ImageDraw.Draw(img)
-    fillcolor = ImageColor.getcolor(color)
-    draw.text(tuple(pos), text, fill=fillcolor, font=font)
-    del draw
+    img = writetext_image(img, items)
     img.save(filename)
 
 
-def Base_image_filter(self, param):
-    """
-    - name: image filter
-      image_filter:
-        input: input.png
-        output: output.png
-        filter:
-          - ModeFilter: 12
-          - GaussianBlur: 5
-          - ModeFilter: 12
-          - GaussianBlur: 1
-    """
-    input_filename, filename = inout_fname(param)
-    img = Image.open(input_filename)
-    for f in param.get("filter", []):
+def filter_image(img, filters):
+    for f in filters:
         if not isinstance(f, dict):
             raise Exception("invalid parameter: %s" % (f))
         for k, v in f.items():
             fn = getattr(ImageFilter, k)
             if not callable(fn):
                 raise Exception("filter %s(%s) not found" % (k, v))
-            self.log.debug("filter %s %s", k, v)
             if v is None:
                 img = img.filter(fn)
             elif isinstance(v, (tuple, list)):
@@ -218,6 +1010,36 @@ def Base_image_filter(self, param):
                 img = img.filter(fn(**v))
             else:
                 img = img.filter(fn(v))
+    return img
+
+
+def Base_image_filter(self, param):
+    """
+    - name: image filter
+      image_filter:
+        input: input.png
+        output: output.png
+        filter:
+          - ModeFilter: 12
+          - GaussianBlur: 5
+          - ModeFilter: 12
+          - GaussianBlur: 1
+    - name: filter very large image in bands
+      image_filter:
+        input: fullpage.png
+        output: output.png
+        memory: 64M    # or tiled: 512 (rows per band)
+        filter:
+          - GaussianBlur: 2
+    """
+    filters = param.get("filter", [])
+    self.log.debug("filter %s", filters)
+    if is_tiled(param):
+        margin = sum([filter_margin(k, v) for f in filters for k, v in f.items()])
+        return tiled_process(self, param, functools.partial(filter_image, filters=filters), margin)
+    input_filename, filename = inout_fname(param)
+    img = Image.open(input_filename)
+    img = filter_image(img, filters)
     img.save(filename)
 
 
@@ -237,6 +1059,12 @@ image_convert_schema = {
 }
 
 
+def convert_image(img, mode):
+    if mode is None:
+        raise Exception("invalid parameter: mode=%s" % (mode))
+    return img.convert(mode)
+
+
 def Base_image_convert(self, param):
     """
     - name: grayscale
@@ -249,10 +1077,41 @@ def Base_image_convert(self, param):
     mode = param.get("mode")
     if mode is None:
         raise Exception("invalid parameter: %s" % (param))
-    img = img.convert(mode)
+    img = convert_image(img, mode)
     img.save(filename)
 
 
+def chops_args(filters):
+    """[(fn, filename, args)]"""
+    res = []
+    for f in filters:
+        if not isinstance(f, dict):
+            raise Exception("invalid parameter: %s" % (f))
+        for k, v in f.items():
+            fn = getattr(ImageChops, k)
+            if not callable(fn):
+                raise Exception("chop %s(%s) not found" % (k, v))
+            if isinstance(v, (list, tuple)):
+                res.append((fn, v[0], v[1:]))
+            else:
+                res.append((fn, v, []))
+    return res
+
+
+def chops_image(img, filters, others=None):
+    """others: images to apply (same size as img). opened from filters if not set"""
+    chops = chops_args(filters)
+    if others is None:
+        others = [Image.open(x[1]) for x in chops]
+    for (fn, _, args), img2 in zip(chops, others):
+        img = fn(img, img2, *args)
+    return img
+
+
+def chops_bands(filters, img, *others):
+    return chops_image(img, filters, others)
+
+
 def Base_image_chops(self, param):
     """
     - name: blend image
@@ -261,26 +1120,30 @@ def Base_image_chops(self, param):
         filter:
           - blend: [addimage.png, 0.5]
           - darker: darklimit.png
+        memory: 128M
     """
+    filters = param.get("filter", [])
+    self.log.debug("chop %s", filters)
+    if is_tiled(param):
+        others = [x[1] for x in chops_args(filters)]
+        return tiled_process(self, param, functools.partial(chops_bands, filters), 0, others)
     input_filename, filename = inout_fname(param)
     img = Image.open(input_filename)
-    for f in param.get("filter", []):
+    img = chops_image(img, filters)
+    img.save(filename)
+
+
+def enhance_image(img, filters):
+    for f in filters:
         if not isinstance(f, dict):
-            raise Exception("invalid parameter: %s" % (param))
+            raise Exception("invalid parameter: %s" % (f))
         for k, v in f.items():
-            fn = getattr(ImageChops, k)
+            fn = getattr(ImageEnhance, k)
             if not callable(fn):
-                raise Exception("chop %s(%s) not found" % (k, v))
-            self.log.debug("chop %s %s", k, v)
-            if isinstance(v, (list, tuple)):
-                fname = v[0]
-                args = v[1:]
-            else:
-                fname = v
-                args = []
-            img2 = Image.open(fname)
-            img = fn(img, img2, *args)
-    img.save(filename)
+                raise Exception("enhance %s(%s) not found" % (k, v))
+            enhancer = fn(img)
+            img = enhancer.enhance(v)
+    return img
 
 
 def Base_image_enhance(self, param):
@@ -291,20 +1154,29 @@ def Base_image_enhance(self, param):
         filter:
           - Sharpness: 0.5
           - Brightness: 1.2
+        tiled: true    # Contrast cannot be used in bands
     """
+    filters = param.get("filter", [])
+    self.log.debug("enhance %s", filters)
+    if is_tiled(param):
+        margin = sum([enhance_margin(k) for f in filters for k in f.keys()])
+        return tiled_process(self, param, functools.partial(enhance_image, filters=filters), margin)
     input_filename, filename = inout_fname(param)
     img = Image.open(input_filename)
-    for f in param.get("filter", []):
+    img = enhance_image(img, filters)
+    img.save(filename)
+
+
+def ops_image(img, filters):
+    for f in filters:
         if not isinstance(f, dict):
-            raise Exception("invalid parameter: %s" % (param))
+            raise Exception("invalid parameter: %s" % (f))
         for k, v in f.items():
-            fn = getattr(ImageEnhance, k)
+            fn = getattr(ImageOps, k)
             if not callable(fn):
-                raise Exception("enhance %s(%s) not found" % (k, v))
-            self.log.debug("enhance %s %s", k, v)
-            enhancer = fn(img)
-            img = enhancer.enhance(v)
-    img.save(filename)
+                raise Exception("ops %s(%s) not found" % (k, v))
+            img = fn(img, *v)
+    return img
 
 
 def Base_image_ops(self, param):
@@ -319,34 +1191,299 @@ def Base_image_ops(self, param):
     """
     input_filename, filename = inout_fname(param)
     img = Image.open(input_filename)
-    for f in param.get("filter", []):
-        if not isinstance(f, dict):
-            raise Exception("invalid parameter: %s" % (param))
-        for k, v in f.items():
-            fn = getattr(ImageOps, k)
-            if not callable(fn):
-                raise Exception("ops %s(%s) not found" % (k, v))
-            self.log.debug("ops %s %s", k, v)
-            img = fn(img, *v)
+    self.log.debug("ops %s", param.get("filter", []))
+    img = ops_image(img, param.get("filter", []))
+    img.save(filename)
+
+
+def pipeline_crop(img, arg):
+    if isinstance(arg, dict):
+        return crop_image(img, arg.get("size", "auto"), arg.get("tolerance", 100))
+    return crop_image(img, arg)
+
+
+def pipeline_resize(img, arg):
+    if isinstance(arg, dict):
+        return resize_image(img, arg.get("size"), arg.get("percent"), arg.get("algorithm", "NEAREST"))
+    return resize_image(img, arg)
+
+
+def pipeline_writetext(img, arg):
+    if isinstance(arg, str):
+        return writetext_image(img, [{"text": arg}])
+    return writetext_image(img, text_items(arg))
+
+
+# name of operation -> fn(img, arg). same vocabulary as image_* steps
+pipeline_ops = {
+    "crop": pipeline_crop,
+    "resize": pipeline_resize,
+    "writetext": pipeline_writetext,
+    "filter": filter_image,
+    "convert": convert_image,
+    "chops": chops_image,
+    "enhance": enhance_image,
+    "ops": ops_image,
+}
+
+
+def run_pipeline(input_filename, filename, ops):
+    """decode once, apply all operations, encode once. runs in worker process"""
+    img = Image.open(input_filename)
+    for op in ops:
+        if not isinstance(op, dict) or len(op) != 1:
+            raise Exception("invalid operation: %s" % (op))
+        k, v = list(op.items())[0]
+        if k not in pipeline_ops:
+            raise Exception("operation %s not found" % (k))
+        img = pipeline_ops[k](img, v)
     img.save(filename)
+    return filename
+
+
+image_pipeline_schema = yaml.safe_load("""
+type: object
+properties:
+  input: {type: string}
+  output: {type: string}
+  workers: {type: integer}
+  ops:
+    type: array
+    items:
+      type: object
+      minProperties: 1
+      maxProperties: 1
+      properties:
+        crop: {}
+        resize: {}
+        writetext: {}
+        filter: {type: array}
+        convert: {type: string}
+        chops: {type: array}
+        enhance: {type: array}
+        ops: {type: array}
+      additionalProperties: false
+required: [input, ops]
+""")
+
+
+def Base_image_pipeline(self, param):
+    """
+    - name: process image in memory
+      image_pipeline:
+        input: filename.png
+        output: output.png
+        ops:
+          - crop: auto
+          - resize: {percent: 50, algorithm: LANCZOS}
+          - enhance:
+              - Sharpness: 0.5
+          - convert: L
+          - writetext: {text: hello world, position: [10, 10], color: black}
+    - name: process many images in parallel
+      image_pipeline:
+        input: "shots/*.png"
+        output: thumbs/     # directory
+        workers: 4
+        ops:
+          - resize: {size: [160, 120]}
+    """
+    input_filename = param.get("input")
+    output = param.get("output")
+    ops = param.get("ops", [])
+    if input_filename is None:
+        raise Exception("please set input: %s" % (param))
+    if not glob.has_magic(input_filename):
+        self.log.info("pipeline %s -> %s: %s", input_filename, output or input_filename, ops)
+        return run_pipeline(input_filename, output or input_filename, ops)
+    inputs = sorted(glob.glob(input_filename))
+    if output is None:
+        outputs = inputs
+    else:
+        os.makedirs(output, exist_ok=True)
+        outputs = [os.path.join(output, os.path.basename(x)) for x in inputs]
+    self.log.info("pipeline %d files -> %s: %s", len(inputs), output, ops)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=param.get("workers")) as ex:
+        return list(ex.map(run_pipeline, inputs, outputs, [ops] * len(inputs)))
+
+
+image_archive_schema = yaml.safe_load("""
+allOf:
+  - "$ref": "#/definitions/common/inout"
+  - type: object
+    properties:
+      delete: {type: boolean}
+      compress: {type: integer}
+      close: {type: boolean}
+""")
 
 
 def Base_image_archive(self, param):
-    input_filename, filename = inout_fname(param)
+    """
+    - name: add image to archive (written in background)
+      image_archive:
+        input: filename.png
+        output: images.tar.gz  # .zip, .cbz, .tar, .tar.gz, .tar.bz2, .tar.xz
+        compress: 6
+        delete: true
+    - name: flush and close archive
+      image_archive:
+        output: images.tar.gz
+        close: true
+    """
+    filename = param.get("output")
+    if filename is None:
+        raise Exception("please set output: %s" % (param))
+    if param.get("close", False):
+        close_archive(self, filename)
+        return filename
+    input_filename = param.get("input")
+    if input_filename is None:
+        raise Exception("please set input: %s" % (param))
     delflag = param.get("delete", True)
     assert input_filename != filename
-    base, ext = os.path.splitext(filename)
-    if ext in (".zip", ".cbz"):
-        with zipfile.ZipFile(filename, 'a') as zf:
-            self.log.debug("zip %s %s", filename, input_filename)
-            zf.write(input_filename)
-            if delflag:
-                os.unlink(input_filename)
-    elif ext in (".tar"):
-        with tarfile.open(filename, 'a') as tf:
-            self.log.debug("tar %s %s", filename, input_filename)
-            tf.add(input_filename)
-            if delflag:
-                os.unlink(input_filename)
+    self.log.debug("archive %s %s", filename, input_filename)
+    get_archive(self, filename, param.get("compress")).add(input_filename, delete=delflag)
+    return filename
+
+
+def gray_array(a):
+    if a.ndim == 2:
+        return a.astype(numpy.float32)
+    return a[:, :, :3].astype(numpy.float32) @ numpy.array([0.299, 0.587, 0.114], dtype=numpy.float32)
+
+
+def ssim_tiles(ga, gb, mask, tile, c1=(0.01 * 255) ** 2, c2=(0.03 * 255) ** 2):
+    """SSIM of each tile in a band. returns (number of pixels, sum of SSIM weighted by pixels)"""
+    starts = numpy.arange(0, ga.shape[1], tile)
+
+    def tilesum(x):
+        return numpy.add.reduceat(x.sum(axis=0).astype(numpy.float64), starts)
+    m = mask.astype(numpy.float32)
+    n = tilesum(m)
+    ok = n != 0
+    n = n[ok]
+    ga = ga * m
+    gb = gb * m
+    mx = tilesum(ga)[ok] / n
+    my = tilesum(gb)[ok] / n
+    vx = tilesum(ga * ga)[ok] / n - mx * mx
+    vy = tilesum(gb * gb)[ok] / n - my * my
+    cov = tilesum(ga * gb)[ok] / n - mx * my
+    s = ((2 * mx * my + c1) * (2 * cov + c2)) / ((mx * mx + my * my + c1) * (vx + vy + c2))
+    return int(n.sum()), float((s * n).sum())
+
+
+def compare_images(input_filename, baseline, output=None, ignore=(), tile=64, tolerance=16):
+    """compare 2 images tile by tile. returns SSIM-like score and ratio of changed pixels"""
+    res = {"input": input_filename, "baseline": baseline, "output": output}
+    img1 = Image.open(input_filename)
+    img2 = Image.open(baseline)
+    if img1.size != img2.size:
+        res.update({"score": 0.0, "changed": 1.0, "error": "size mismatch: %s != %s" % (img1.size, img2.size)})
+        return res
+    if img1.mode not in ("L", "RGB", "RGBA"):
+        img1 = img1.convert("RGB")
+    if img2.mode != img1.mode:
+        img2 = img2.convert(img1.mode)
+    width, height = img1.size
+    heat = None
+    if output is not None:
+        heat = Image.new("RGB", img1.size)
+    ssim = 0.0
+    weight = 0
+    changed = 0
+    for (y, a), (_, b) in zip(bands(img1, tile), bands(img2, tile)):
+        d = absdiff(a, b)
+        if d.ndim == 3:
+            # much faster than d.max(axis=2) for few channels
+            d = functools.reduce(numpy.maximum, [d[:, :, i] for i in range(d.shape[2])])
+        mask = numpy.ones(d.shape, dtype=bool)
+        for x1, y1, x2, y2 in ignore:
+            mask[max(y1 - y, 0):max(y2 - y, 0), x1:x2] = False
+        changed += int(numpy.count_nonzero((d > tolerance) & mask))
+        ga = gray_array(a)
+        gb = gray_array(b)
+        n, score = ssim_tiles(ga, gb, mask, tile)
+        ssim += score
+        weight += n
+        if heat is not None:
+            # changed pixels in red over dimmed input
+            dim = (ga * 0.3).astype(numpy.uint8)
+            red = numpy.maximum(dim, numpy.where(mask, d, 0).astype(numpy.uint8))
+            heat.paste(Image.fromarray(numpy.dstack([red, dim, dim])), (0, y))
+    if heat is not None:
+        heat.save(output)
+    res["score"] = float(ssim / weight) if weight != 0 else 1.0
+    res["changed"] = changed / weight if weight != 0 else 0.0
+    return res
+
+
+image_compare_schema = yaml.safe_load("""
+type: object
+properties:
+  input: {type: string}
+  baseline: {type: string}
+  output: {type: string}
+  ignore:
+    type: array
+    items:
+      type: array
+      items: {type: integer}
+      minItems: 4
+      maxItems: 4
+  tile: {type: integer}
+  tolerance: {type: integer}
+  threshold: {type: number}
+  workers: {type: integer}
+required: [input, baseline]
+""")
+
+
+def Base_image_compare(self, param):
+    """
+    - name: compare with baseline
+      image_compare:
+        input: shot.png
+        baseline: baseline/shot.png
+        output: diff.png      # heatmap
+        ignore:
+          - [0, 0, 1920, 80]  # left, upper, right, lower
+        threshold: 0.99
+      register: result
+    - name: compare all images in directory
+      image_compare:
+        input: shots/
+        baseline: baseline/
+        output: diff/
+        workers: 4
+    """
+    input_filename = param.get("input")
+    baseline = param.get("baseline")
+    output = param.get("output")
+    if input_filename is None or baseline is None:
+        raise Exception("please set input and baseline: %s" % (param))
+    threshold = param.get("threshold")
+    fn = functools.partial(compare_images, ignore=param.get("ignore", []), tile=param.get("tile", 64),
+                           tolerance=param.get("tolerance", 16))
+    if os.path.isdir(input_filename):
+        names = sorted([x for x in os.listdir(input_filename)
+                        if os.path.isfile(os.path.join(baseline, x))])
+        inputs = [os.path.join(input_filename, x) for x in names]
+        baselines = [os.path.join(baseline, x) for x in names]
+        if output is not None:
+            os.makedirs(output, exist_ok=True)
+            outputs = [os.path.join(output, x) for x in names]
+        else:
+            outputs = [None] * len(names)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=param.get("workers")) as ex:
+            res = list(ex.map(fn, inputs, baselines, outputs))
     else:
-        raise Exception("not implemented yet: archive %s" % (param,))
+        res = [fn(input_filename, baseline, output)]
+    for r in res:
+        if threshold is not None:
+            r["passed"] = r["score"] >= threshold
+        self.log.info("compare %s: score=%f, changed=%f", r["input"], r["score"], r["changed"])
+    if os.path.isdir(input_filename):
+        return res
+    return res[0]
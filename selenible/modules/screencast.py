@@ -1,12 +1,87 @@
 import io
+import os
+import base64
+import json
+import functools
 import time
+import queue
+import shutil
+import tempfile
 import threading
+import subprocess
 from logging import getLogger
 from PIL import Image
+try:
+    import websocket
+except ImportError:
+    websocket = None
+from .imageproc import image_hash, hash_distance
+
+
+class framespool:
+    """frames are written to temporary directory as they arrive"""
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix="selenible-cast-")
+        self.frames = []  # (timestamp, filename, hash)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, img, ts, seq, h=None):
+        fn = os.path.join(self.dir, "%08d.png" % (seq))
+        img.save(fn, compress_level=1)
+        with self.lock:
+            self.frames.append((ts, fn, h))
+        return fn
+
+    def dedup(self, threshold):
+        """drop frames nearly identical to previous kept one. frames are sorted by timestamp"""
+        self.frames.sort()
+        res = []
+        dropped = 0
+        for x in self.frames:
+            if len(res) != 0 and hash_distance(x[2], res[-1][2]) <= threshold:
+                os.unlink(x[1])
+                dropped += 1
+            else:
+                res.append(x)
+        self.frames = res
+        return dropped
+
+    def cleanup(self):
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+
+class lazyframes:
+    """re-iterable list of frames. opened only when the encoder asks"""
+
+    def __init__(self, frames):
+        self.frames = frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        for x in self.frames:
+            # encoder may hold every frame (e.g. list(append_images)).
+            # load() reads whole file and closes it
+            img = Image.open(x[1])
+            img.load()
+            yield img
+
+
+# extensions encoded by external encoder (ffmpeg)
+video_exts = (".mp4", ".webm", ".mkv", ".mov", ".avi")
+# pillow keeps every frame of gif/apng/webp in memory until the file is written.
+pillow_keepall_exts = (".gif", ".png", ".apng", ".webp")
 
 
 class screencast(threading.Thread):
-    def __init__(self, drvobj, crop, interval=1.0, thumbnail=None):
+    def __init__(self, drvobj, crop, interval=1.0, thumbnail=None, dedup=None, workers=2, queuesize=8):
         super().__init__()
         self.drvobj = drvobj
         if crop is None:
@@ -17,59 +92,264 @@ class screencast(threading.Thread):
         self.log = getLogger(self.name)
         self.stop = False
         self.interval = interval
-        self.frames = []
+        self.dedup = dedup
+        self.frames = framespool()
+        self.last_png = None
+        # capture thread only takes png; decode/crop/thumbnail/encode in workers
+        self.frameq = queue.Queue(queuesize)
+        self.workers = [threading.Thread(target=self.process) for _ in range(workers)]
+        self.captured = 0
+        self.duplicated = 0
+        self.overrun = 0
+        self.dropped = 0
+        self.seq = 0
 
     def run(self):
+        for w in self.workers:
+            w.start()
         self.start_ts = time.time()
+        try:
+            self.capture()
+        finally:
+            self.finished_ts = time.time()
+            for w in self.workers:
+                self.frameq.put(None)
+            for w in self.workers:
+                w.join()
+
+    def capture(self):
         while not self.stop:
             t1 = time.time()
             with self.drvobj.lock:
                 p = self.drvobj.saveshot()
                 self.log.info("shot: %d bytes, %f sec", len(p), time.time() - t1)
-            if len(p) != 0:
-                img = Image.open(io.BytesIO(p))
-                if self.crop is not None:
-                    self.log.info("crop %s, %f sec", self.crop, time.time() - t1)
-                    img = img.crop(self.crop)
-                if self.thumbnail is not None:
-                    img.thumbnail(self.thumbnail, Image.ANTIALIAS)
-                self.frames.append(img)
+            self.push(p, t1)
             td = time.time() - t1
             if self.interval is not None and self.interval > td:
                 self.log.info("sleep %f - %f", self.interval, td)
                 time.sleep(self.interval - td)
-        self.finished_ts = time.time()
 
-    def savefile(self, output_fn, optimize=False, loop=0, speed=1.0):
+    def push(self, p, ts, wait=False):
+        """queue a frame. if wait, block while workers are busy (until stopped) instead of dropping"""
+        if len(p) == 0:
+            return
+        self.captured += 1
+        if p == self.last_png:
+            # nothing changed: previous frame lasts longer
+            self.duplicated += 1
+            return
+        while True:
+            try:
+                self.frameq.put((self.seq, ts, p), block=wait, timeout=0.5 if wait else None)
+                self.last_png = p
+                self.seq += 1
+                return
+            except queue.Full:
+                if not wait or self.stop:
+                    break
+        self.log.info("frame dropped: queue full")
+        self.overrun += 1
+
+    def process(self):
+        while True:
+            item = self.frameq.get()
+            if item is None:
+                break
+            seq, ts, p = item
+            t1 = time.time()
+            img = Image.open(io.BytesIO(p))
+            if self.crop is not None:
+                img = img.crop(self.crop)
+            if self.thumbnail is not None:
+                img.thumbnail(self.thumbnail, Image.LANCZOS)
+            h = None
+            if self.dedup is not None:
+                h = image_hash(img)
+            self.frames.add(img, ts, seq, h)
+            self.log.debug("frame %d: %f sec", seq, time.time() - t1)
+
+    def durations(self, speed=1.0):
+        # each frame lasts until next frame is captured
+        ts = [x[0] for x in self.frames.frames] + [self.finished_ts]
+        return [1000 * (ts[i + 1] - ts[i]) / speed for i in range(len(self.frames))]
+
+    def savefile(self, output_fn, optimize=False, loop=0, speed=1.0, encoder="auto", timestamps=None,
+                 pillow_limit=300):
         if len(self.frames) == 0:
             raise Exception("no image found")
-        d = 1000 * (self.finished_ts - self.start_ts) / len(self.frames) / speed
-        self.log.info("%d frames, %d sec. duration=%f(ms)", len(
-            self.frames), self.finished_ts - self.start_ts, d)
-        self.frames[0].save(output_fn, save_all=True, duration=d, optimize=optimize,
-                            loop=loop, append_images=self.frames[1:])
+        self.frames.frames.sort()
+        if self.dedup is not None:
+            self.dropped = self.frames.dedup(self.dedup)
+        durations = self.durations(speed)
+        self.log.info("%d frames, %d sec. duration=%f..%f(ms)", len(self.frames),
+                      self.finished_ts - self.start_ts, min(durations), max(durations))
+        self.log.info("captured=%d, unchanged=%d, dropped(queue full)=%d, dropped(dedup)=%d",
+                      self.captured, self.duplicated, self.overrun, self.dropped)
+        self.drvobj.add_summary("screencast", frames=len(self.frames), captured=self.captured,
+                                unchanged=self.duplicated, overrun=self.overrun, dedup=self.dropped)
+        if timestamps is not None:
+            with open(timestamps, "w") as f:
+                json.dump([{"frame": i, "timestamp": ts, "duration": d}
+                           for i, ((ts, _, _), d) in enumerate(zip(self.frames.frames, durations))], f)
+        ext = os.path.splitext(output_fn)[1].lower()
+        if encoder == "auto":
+            if ext in video_exts:
+                encoder = "ffmpeg"
+            elif ext in pillow_keepall_exts and len(self.frames) > pillow_limit and shutil.which("ffmpeg"):
+                self.log.info("%d frames: encode %s by ffmpeg", len(self.frames), output_fn)
+                encoder = "ffmpeg"
+            else:
+                encoder = "pillow"
+        if encoder == "pillow" and ext in pillow_keepall_exts and len(self.frames) > pillow_limit:
+            self.log.warning("%d frames are kept in memory while writing %s. install ffmpeg or use mp4/webm",
+                             len(self.frames), output_fn)
+        if encoder == "ffmpeg":
+            self.save_ffmpeg(output_fn, durations, loop)
+        elif encoder == "pillow":
+            if ext == ".gif":
+                # gif frame delay is 16bit, 1/100 sec
+                durations = [min(x, 655350) for x in durations]
+            first = Image.open(self.frames.frames[0][1])
+            first.save(output_fn, save_all=True, duration=durations, optimize=optimize,
+                       loop=loop, append_images=lazyframes(self.frames.frames[1:]))
+        else:
+            raise Exception("unknown encoder: %s" % (encoder))
+
+    def save_ffmpeg(self, output_fn, durations, loop=0):
+        if shutil.which("ffmpeg") is None:
+            raise Exception("ffmpeg not found")
+        listfn = os.path.join(self.frames.dir, "frames.txt")
+        with open(listfn, "w") as f:
+            f.write("ffconcat version 1.0\n")
+            for (_, fn, _), d in zip(self.frames.frames, durations):
+                f.write("file '%s'\nduration %f\n" % (fn, d / 1000.0))
+            # last frame should be written twice (see ffmpeg concat demuxer)
+            f.write("file '%s'\n" % (self.frames.frames[-1][1]))
+        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", listfn, "-vsync", "vfr"]
+        ext = os.path.splitext(output_fn)[1].lower()
+        if ext == ".gif":
+            # palette for each frame: whole stream is not buffered
+            cmd.extend(["-vf", "split[a][b];[a]palettegen=stats_mode=single[p];[b][p]paletteuse=new=1",
+                        "-loop", str(loop)])
+        elif ext in (".png", ".apng"):
+            cmd.extend(["-f", "apng", "-plays", str(loop)])
+        elif ext == ".webp":
+            cmd.extend(["-c:v", "libwebp", "-loop", str(loop)])
+        else:
+            cmd.extend(["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"])
+        cmd.append(output_fn)
+        self.log.debug("encode: %s", cmd)
+        subprocess.check_call(cmd, stdin=subprocess.DEVNULL)
+
+    def discard(self):
+        self.stop = True
+        if self.is_alive():
+            self.join(2)
+        self.frames.cleanup()
+
+
+class devtoolscast(screencast):
+    """frames are pushed by chrome (DevTools Page.startScreencast)"""
+
+    def __init__(self, drvobj, wsurl, crop, thumbnail=None, dedup=None, workers=2, queuesize=8,
+                 quality=80, every=1):
+        super().__init__(drvobj, crop, None, thumbnail, dedup, workers, queuesize)
+        self.wsurl = wsurl
+        self.quality = quality
+        self.every = every
+        self.msgid = 0
+
+    def connect(self):
+        return websocket.create_connection(self.wsurl, timeout=0.5)
+
+    def send(self, ws, method, params=None):
+        self.msgid += 1
+        ws.send(json.dumps({"id": self.msgid, "method": method, "params": params or {}}))
+
+    def capture(self):
+        ws = self.connect()
+        params = {"format": "jpeg", "quality": self.quality, "everyNthFrame": self.every}
+        if self.crop is None and self.thumbnail is not None:
+            # let browser shrink the frame
+            params["maxWidth"], params["maxHeight"] = self.thumbnail
+        self.send(ws, "Page.startScreencast", params)
+        try:
+            while not self.stop:
+                try:
+                    msg = json.loads(ws.recv())
+                except websocket.WebSocketTimeoutException:
+                    continue
+                if msg.get("method") != "Page.screencastFrame":
+                    continue
+                frame = msg.get("params", {})
+                ts = frame.get("metadata", {}).get("timestamp", time.time())
+                # browser sends next frame only after ack: ack when workers accept this one
+                self.push(base64.b64decode(frame.get("data", "")), ts, wait=True)
+                self.send(ws, "Page.screencastFrameAck", {"sessionId": frame.get("sessionId")})
+        finally:
+            self.send(ws, "Page.stopScreencast")
+            ws.close()
 
 
 scr_th = None
 
 
+def discard_screencast(th):
+    # finalizer: stop threads of unsaved screencast
+    global scr_th
+    th.discard()
+    if scr_th is th:
+        scr_th = None
+
+
 def Base_screencast(self, param):
     """
     - name: start screencast
       screencast:
         interval: 0.5
         thumbnail: [100, 100]
+        dedup: 2   # drop frames nearly identical to previous one
+        workers: 2
+        queue: 8   # max frames waiting for workers
+        backend: auto   # auto, poll, devtools (chrome only)
     - name: sleep
       sleep: 3
     - name: save screencast
       screencast: output.gif
+    - name: save screencast as video (using ffmpeg)
+      screencast:
+        output: output.mp4
+        timestamps: output.json
+    - name: save long screencast
+      screencast:
+        output: output.gif
+        # gif/apng/webp: pillow holds all frames in memory. ffmpeg is used for more than pillow_limit frames
+        pillow_limit: 300
     """
     global scr_th
     if isinstance(param, dict) and "output" not in param:
         if scr_th is not None:
             raise Exception("screencast already working")
-        scr_th = screencast(self, param.get("crop"), param.get("interval"),
-                            param.get("thumbnail"))
+        backend = param.get("backend", "auto")
+        wsurl = None
+        if backend == "auto" and websocket is None and hasattr(self, "devtools_websocket"):
+            self.log.info("websocket-client is not installed. fallback to polling screencast")
+        if backend in ("auto", "devtools") and websocket is not None and hasattr(self, "devtools_websocket"):
+            wsurl = self.devtools_websocket()
+        if backend == "devtools" and websocket is None:
+            raise Exception("devtools screencast requires websocket-client: pip install 'selenible[screencast]'")
+        if backend == "devtools" and wsurl is None:
+            raise Exception("devtools screencast is not supported")
+        if wsurl is not None and backend != "poll":
+            self.log.info("devtools screencast: %s", wsurl)
+            scr_th = devtoolscast(self, wsurl, param.get("crop"), param.get("thumbnail"),
+                                  param.get("dedup"), param.get("workers", 2), param.get("queue", 8),
+                                  param.get("quality", 80), param.get("every", 1))
+        else:
+            scr_th = screencast(self, param.get("crop"), param.get("interval"),
+                                param.get("thumbnail"), param.get("dedup"),
+                                param.get("workers", 2), param.get("queue", 8))
+        self.add_finalizer(functools.partial(discard_screencast, scr_th))
         scr_th.start()
         return "started"
     if scr_th is None:
@@ -81,16 +361,22 @@ def Base_screencast(self, param):
         self.log.warn("cannot stop screencast thread.")
     else:
         self.log.debug("done join. saving")
-    if isinstance(param, str):
-        self.log.info("save to %s", param)
-        scr_th.savefile(param)
-    elif isinstance(param, dict):
-        output = param.get("output")
-        assert output is not None
-        self.log.info("save to %s", output)
-        scr_th.savefile(output,
-                        optimize=param.get("optimize", False),
-                        loop=param.get("loop", 0),
-                        speed=param.get("speed", 1.0))
-    scr_th = None
+    try:
+        if isinstance(param, str):
+            self.log.info("save to %s", param)
+            scr_th.savefile(param)
+        elif isinstance(param, dict):
+            output = param.get("output")
+            assert output is not None
+            self.log.info("save to %s", output)
+            scr_th.savefile(output,
+                            optimize=param.get("optimize", False),
+                            loop=param.get("loop", 0),
+                            speed=param.get("speed", 1.0),
+                            encoder=param.get("encoder", "auto"),
+                            timestamps=param.get("timestamps"),
+                            pillow_limit=param.get("pillow_limit", 300))
+    finally:
+        scr_th.frames.cleanup()
+        scr_th = None
     return "finished"
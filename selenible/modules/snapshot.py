@@ -0,0 +1,40 @@
+import yaml
+from lxml import etree
+
+snapshot_schema = yaml.safe_load("""
+oneOf:
+  - type: string
+    enum: [take, refresh, clear, "off"]
+  - type: "null"
+  - type: object
+""")
+
+
+def take_snapshot(self):
+    source = self.driver.page_source
+    self.dom = {
+        "url": self.driver.current_url,
+        "source": source,
+        "tree": etree.HTML(source),
+    }
+    self.variables["current_url"] = self.dom["url"]
+    return self.dom
+
+
+def Base_snapshot(self, param):
+    """
+    - name: take DOM snapshot. set/save/assert read the snapshot until navigation
+      snapshot: take
+    - name: re-read DOM after click or script changes the page
+      snapshot: refresh
+    - name: read from browser again
+      snapshot: clear
+    """
+    if param in (None, "take", "refresh") or isinstance(param, dict):
+        t = take_snapshot(self)
+        self.log.info("snapshot %s: %d bytes", t["url"], len(t["source"]))
+        return t["url"]
+    if param in ("clear", "off"):
+        self.dom = None
+        return None
+    raise Exception("invalid parameter: %s" % (param))
@@ -1,6 +1,11 @@
 import json
+import time
 import yaml
+import queue
+import functools
+import threading
 import requests
+from logging import getLogger
 
 webhook_schema = yaml.safe_load("""
 type: object
@@ -11,10 +16,155 @@ properties:
   method: {type: string}
   cookies: {type: object}
   headers: {type: object}
+  background: {type: boolean}
+  batch: {type: integer}
+  batch_wait: {type: number}
+  retry: {type: integer}
+  backoff: {type: number}
+  queue: {type: integer}
+  policy: {type: string, enum: [block, drop]}
 required: [url, body]
 """)
 
 
+def request_args(params):
+    return {
+        "method": params.get("method", "post"),
+        "url": params.get("url"),
+        "params": params.get("query", {}),
+        "headers": params.get("headers", {"content-type": "application/json"}),
+        "cookies": params.get("cookies", {}),
+        "timeout": params.get("timeout", None),
+    }
+
+
+def batch_key(params):
+    # events are put into one request only when they go to same endpoint
+    return json.dumps([params.get(k) for k in ("url", "method", "query", "headers", "cookies", "batch")],
+                      sort_keys=True)
+
+
+# end of queue. distinct from "nothing pending" (None)
+stop_delivery = object()
+
+
+class webhookqueue(threading.Thread):
+    """deliver webhook in background. events may be sent in batch"""
+
+    def __init__(self, drvobj, queuesize=100, policy="block"):
+        super().__init__()
+        self.drvobj = drvobj
+        self.log = getLogger(self.__class__.__name__)
+        self.queue = queue.Queue(queuesize)
+        self.policy = policy
+        self.pending = None
+        # not shared with download: no browser cookies, used only by this thread
+        self.session = requests.Session()
+        self.daemon = True
+
+    def put(self, params):
+        if self.policy == "drop":
+            try:
+                self.queue.put_nowait(params)
+            except queue.Full:
+                self.log.warning("webhook queue full. dropped: %s", params.get("url"))
+                self.drvobj.add_summary("webhook", dropped=1)
+        else:
+            self.queue.put(params)
+
+    def next(self, timeout=None):
+        if self.pending is not None:
+            item, self.pending = self.pending, None
+            return item
+        if timeout is None:
+            return self.queue.get()
+        return self.queue.get(timeout=timeout)
+
+    def run(self):
+        while True:
+            item = self.next()
+            if item is stop_delivery:
+                self.queue.task_done()
+                break
+            batch = [item]
+            size = item.get("batch", 1)
+            deadline = time.time() + item.get("batch_wait", 1.0)
+            while len(batch) < size:
+                try:
+                    nxt = self.next(max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if nxt is stop_delivery or batch_key(nxt) != batch_key(item):
+                    self.pending = nxt
+                    break
+                batch.append(nxt)
+            try:
+                self.send(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def send(self, batch):
+        params = batch[0]
+        if params.get("batch") is None:
+            body = params.get("body", {})
+        else:
+            body = [x.get("body", {}) for x in batch]
+        args = request_args(params)
+        retry = params.get("retry", 3)
+        backoff = params.get("backoff", 0.5)
+        for i in range(retry + 1):
+            try:
+                resp = self.session.request(data=json.dumps(body, ensure_ascii=False), **args)
+                if resp.status_code < 500 and resp.status_code != 429:
+                    self.log.debug("webhook %s: %d events, status %d", args["url"], len(batch), resp.status_code)
+                    self.drvobj.add_summary("webhook", requests=1, events=len(batch))
+                    return
+                err = "status %d" % (resp.status_code)
+            except Exception as e:
+                err = str(e)
+            if i != retry:
+                self.log.info("webhook %s: %s. retry after %f sec", args["url"], err, backoff * 2 ** i)
+                self.drvobj.add_summary("webhook", retry=1)
+                time.sleep(backoff * 2 ** i)
+        self.log.error("webhook %s: %s. give up %d events", args["url"], err, len(batch))
+        self.drvobj.add_summary("webhook", failed=len(batch))
+
+    def close(self):
+        self.queue.put(stop_delivery)
+        self.join()
+        self.session.close()
+
+
+def get_webhookqueue(self, queuesize=100, policy="block"):
+    if getattr(self, "webhookq", None) is None:
+        self.webhookq = webhookqueue(self, queuesize, policy)
+        self.webhookq.start()
+        self.add_barrier(functools.partial(close_webhookqueue, self))
+    return self.webhookq
+
+
+def close_webhookqueue(self):
+    q = getattr(self, "webhookq", None)
+    if q is not None:
+        self.webhookq = None
+        q.close()
+
+
+def get_webhook_session(self):
+    if getattr(self, "webhook_http", None) is None:
+        self.webhook_http = requests.Session()
+        self.add_finalizer(functools.partial(close_webhook_session, self))
+    return self.webhook_http
+
+
+def close_webhook_session(self):
+    sess = getattr(self, "webhook_http", None)
+    if sess is not None:
+        self.webhook_http = None
+        sess.close()
+
+
 def Base_webhook(self, params):
     """
     - name: notify webhook
@@ -24,17 +174,24 @@ def Base_webhook(self, params):
           id: "xyz"
         body:
           text: "hello, world"
+    - name: notify in background (sent in batch of at most 10 events)
+      webhook:
+        url: https://host/path
+        body:
+          text: "hello, world"
+        background: true
+        batch: 10        # body is sent as list
+        batch_wait: 1.0  # seconds to wait for next event
+        retry: 3
+        backoff: 0.5
+        queue: 100
+        policy: drop     # or block, when queue is full
     """
-    url = params.get("url")
-    query = params.get("query", {})
+    if params.get("background", False):
+        q = get_webhookqueue(self, params.get("queue", 100), params.get("policy", "block"))
+        q.put(params)
+        return "queued"
+    args = request_args(params)
     body = params.get("body", {})
-    method = params.get("method", "post")
-    cookies = params.get("cookies", {})
-    headers = params.get("headers", {"content-type": "application/json"})
-    timeout = params.get("timeout", None)
-    sess = requests.Session()
-    for name, value in cookies.items():
-        sess.cookies.set(name, value)
-    resp = sess.request(method, url, params=query, headers=headers, timeout=timeout,
-                        data=json.dumps(body, ensure_ascii=False))
+    resp = get_webhook_session(self).request(data=json.dumps(body, ensure_ascii=False), **args)
     return resp.json()
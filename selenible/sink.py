@@ -0,0 +1,175 @@
+import os
+import csv
+import json
+import time
+import sqlite3
+from logging import getLogger
+
+
+class Sink:
+    """write step results one by one. flushed every `flush` records or `interval` seconds"""
+
+    def __init__(self, filename, flush=1, interval=None):
+        self.filename = filename
+        self.flush_every = flush
+        self.interval = interval
+        self.count = 0
+        self.last_flush = time.time()
+        self.log = getLogger(self.__class__.__name__)
+
+    def write(self, record):
+        self.write1(record)
+        self.count += 1
+        if self.flush_every and self.count % self.flush_every == 0:
+            self.do_flush()
+        elif self.interval is not None and time.time() - self.last_flush >= self.interval:
+            self.do_flush()
+
+    def do_flush(self):
+        self.flush()
+        self.last_flush = time.time()
+
+    def write1(self, record):
+        raise Exception("please implement")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.log.info("%s: %d records", self.filename, self.count)
+
+
+def tojson(v):
+    return json.dumps(v, ensure_ascii=False, default=str)
+
+
+class JsonlSink(Sink):
+    def __init__(self, filename, flush=1, interval=None):
+        super().__init__(filename, flush, interval)
+        self.fp = open(filename, "a")
+
+    def write1(self, record):
+        self.fp.write(tojson(record))
+        self.fp.write("\n")
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        super().close()
+        self.fp.close()
+
+
+class CsvSink(Sink):
+    fields = ["name", "loop", "start", "elapsed"]
+    # keys not in columns are written here as json
+    extra = "extra"
+
+    def __init__(self, filename, flush=1, interval=None):
+        super().__init__(filename, flush, interval)
+        self.columns = None
+        if os.path.exists(filename) and os.stat(filename).st_size != 0:
+            # append: follow existing header
+            with open(filename, newline="") as f:
+                self.columns = next(csv.reader(f), None)
+        self.header = self.columns is not None
+        self.fp = open(filename, "a", newline="")
+        self.writer = None
+        self.warned = set()
+
+    def write1(self, record):
+        res = record.get("result")
+        row = {k: record.get(k) for k in self.fields}
+        if isinstance(res, dict):
+            row.update(res)
+        elif isinstance(res, str):
+            row["result"] = res
+        else:
+            row["result"] = tojson(res)
+        if self.writer is None:
+            if self.columns is None:
+                # columns are fixed by the first record
+                self.columns = [x for x in row.keys() if x != self.extra] + [self.extra]
+            self.writer = csv.DictWriter(self.fp, fieldnames=self.columns)
+            if not self.header:
+                self.writer.writeheader()
+        unknown = {k: row.pop(k) for k in list(row.keys()) if k not in self.columns}
+        if len(unknown) != 0:
+            if self.extra in self.columns:
+                row[self.extra] = tojson(unknown)
+            elif not self.warned.issuperset(unknown.keys()):
+                self.log.warning("%s: no column for %s. dropped", self.filename, list(unknown.keys()))
+                self.warned.update(unknown.keys())
+        self.writer.writerow(row)
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        super().close()
+        self.fp.close()
+
+
+class SqliteSink(Sink):
+    # commit is fsync: batch rows by default. flush: 1 for per-row durability
+    def __init__(self, filename, flush=1000, interval=1.0, table="results"):
+        super().__init__(filename, flush, interval)
+        self.table = table
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        tblname = table.replace('"', '""')
+        self.db.execute('CREATE TABLE IF NOT EXISTS "%s" '
+                        '(name TEXT, loop INTEGER, start REAL, elapsed REAL, result TEXT)' % (tblname))
+        self.insert = 'INSERT INTO "%s" VALUES (?, ?, ?, ?, ?)' % (tblname)
+
+    def write1(self, record):
+        self.db.execute(self.insert, (record.get("name"), record.get("loop"), record.get("start"),
+                                      record.get("elapsed"), tojson(record.get("result"))))
+
+    def flush(self):
+        self.db.commit()
+
+    def close(self):
+        super().close()
+        self.db.commit()
+        self.db.close()
+
+
+sinkmap = {
+    "jsonl": JsonlSink,
+    "csv": CsvSink,
+    "sqlite": SqliteSink,
+}
+
+extmap = {
+    ".jsonl": "jsonl",
+    ".json": "jsonl",
+    ".csv": "csv",
+    ".db": "sqlite",
+    ".sqlite": "sqlite",
+    ".sqlite3": "sqlite",
+}
+
+
+def sink_spec(param):
+    """
+    >>> sink_spec("out.csv")
+    ('csv', 'out.csv', {})
+    >>> sink_spec({"sqlite": "out.db", "table": "t1"})
+    ('sqlite', 'out.db', {'table': 't1'})
+    """
+    if isinstance(param, str):
+        ext = os.path.splitext(param)[1].lower()
+        if ext not in extmap:
+            raise Exception("unknown sink type: %s" % (param))
+        return extmap[ext], param, {}
+    elif isinstance(param, dict):
+        opts = dict(param)
+        for k in sinkmap.keys():
+            if k in opts:
+                fname = opts.pop(k)
+                return k, fname, opts
+    raise Exception("invalid sink: %s" % (param))
+
+
+def open_sink(kind, filename, opts):
+    return sinkmap[kind](filename, **opts)
@@ -17,6 +17,10 @@ setup(
     package_data={"selenible": ["schema/*.yaml", "seleniblepiter/*"]},
     license="MIT",
     install_requires=open("requirements.txt").readlines(),
+    extras_require={
+        # devtools screencast (chrome)
+        "screencast": ["websocket-client"],
+    },
     entry_points={
         "console_scripts": [
             "selenible=selenible.cli:cli"
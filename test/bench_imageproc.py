@@ -0,0 +1,53 @@
+"""
+compare imageproc primitives with previous implementation
+
+    python -m test.bench_imageproc
+"""
+import time
+import resource
+from PIL import Image, ImageChops, ImageDraw
+from selenible.modules import imageproc
+
+
+def autocrop_legacy(img):
+    bg = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+    diff = ImageChops.difference(img, bg)
+    diff = ImageChops.add(diff, diff, 2.0, -100)
+    return diff.getbbox(alpha_only=False)
+
+
+def diff_legacy(img1, img2):
+    return ImageChops.difference(img1, img2).getbbox(alpha_only=False)
+
+
+def diff_numpy(img1, img2):
+    rows = []
+    for y, d in imageproc.diff_bands(img1, img2):
+        if d.any():
+            rows.append(y)
+    return rows[0] if len(rows) != 0 else None
+
+
+def bench(name, fn, *args):
+    t1 = time.time()
+    rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    res = fn(*args)
+    rss2 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("%-12s %8.3f sec, maxrss +%d KiB: %s" % (name, time.time() - t1, rss2 - rss1, res))
+
+
+def main():
+    img = Image.new("RGB", (1920, 20000), "white")
+    ImageDraw.Draw(img).rectangle((100, 300, 1800, 19000), fill="gray")
+    img.load()
+    # numpy version first: maxrss is a high-water mark
+    bench("numpy", imageproc.autocrop_box, img)
+    bench("legacy", autocrop_legacy, img)
+    img2 = img.copy()
+    ImageDraw.Draw(img2).point((1000, 15000), fill="black")
+    bench("diff numpy", diff_numpy, img, img2)
+    bench("diff legacy", diff_legacy, img, img2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
+import os
+import csv
 import json
 import yaml
+import sqlite3
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 from click.testing import CliRunner
-from selenible import cli
+from selenible import cli, sink
 
 
 class TestBase(unittest.TestCase):
@@ -126,6 +130,43 @@ class TestBase(unittest.TestCase):
         res = drv.run([{"name": "dummy", "dummy": None, "with_items": ["a", "b", "c"]}])
         self.assertEqual(res, "hello")
 
+    def test_loop_source(self):
+        def dummymodule(self, param):
+            self.variables.setdefault("seen", []).append(param)
+            return param
+        cls = cli.loadmodules("dummy", [])
+        cls.do_dummy = dummymodule
+        with tempfile.TemporaryDirectory() as td:
+            csvf = os.path.join(td, "items.csv")
+            with open(csvf, "w") as f:
+                f.write("name,value\na,1\nb,2\nc,3\n")
+            jsonlf = os.path.join(td, "items.jsonl")
+            with open(jsonlf, "w") as f:
+                f.write('{"x": 1}\n\n{"x": 2}\n')
+            linesf = os.path.join(td, "items.txt")
+            with open(linesf, "w") as f:
+                f.write("http://a/\nhttp://b/\n\n")
+            drv = cls()
+            drv.run([{"name": "csv", "dummy": "{{item.name}}={{item.value}}", "with_items": {"csv": csvf}}])
+            self.assertEqual(drv.variables["seen"], ["a=1", "b=2", "c=3"])
+            drv.variables["seen"] = []
+            drv.run([{"name": "jsonl", "dummy": "{{item.x}}", "with_items": {"jsonl": jsonlf}}])
+            self.assertEqual(drv.variables["seen"], ["1", "2"])
+            drv.variables["seen"] = []
+            drv.run([{"name": "lines", "dummy": "{{item}}", "with_items": {"lines": linesf},
+                      "loop_control": {"progress": 1}}])
+            self.assertEqual(drv.variables["seen"], ["http://a/", "http://b/"])
+            drv.variables["seen"] = []
+            drv.run([{"name": "chunk", "dummy": "{{item|length}}", "with_items": {"csv": csvf},
+                      "loop_control": {"chunk": 2}}])
+            self.assertEqual(drv.variables["seen"], ["2", "1"])
+        drv.variables["seen"] = []
+        drv.variables["gen"] = (x * 2 for x in range(3))
+        drv.run([{"name": "gen", "dummy": "{{item}}", "with_items": "gen"}])
+        self.assertEqual(drv.variables["seen"], ["0", "2", "4"])
+        res = drv.run([{"name": "empty", "dummy": "x", "with_items": []}])
+        self.assertIsNone(res)
+
     def test_removelocator(self):
         cls = cli.loadmodules("dummy", [])
         drv = cls()
@@ -159,3 +200,103 @@ class TestBase(unittest.TestCase):
         drv.run([{"name": "call func1", "func1": {"a1": "xyz", "a2": "abc"},
                   "register": "rval1"}])
         self.assertEqual(drv.variables.get("rval1", None), "hello")
+
+    def test_sink(self):
+        def dummymodule(self, param):
+            return {"value": param}
+        cls = cli.loadmodules("dummy", [])
+        cls.do_dummy = dummymodule
+        drv = cls()
+        with tempfile.TemporaryDirectory() as td:
+            jsonl = os.path.join(td, "out.jsonl")
+            csvf = os.path.join(td, "out.csv")
+            dbf = os.path.join(td, "out.db")
+            drv.run([
+                {"name": "s1", "dummy": "{{item}}", "with_items": ["a", "b", "c"], "sink": jsonl},
+                {"name": "s2", "dummy": "{{item}}", "with_items": ["a", "b"], "sink": {"csv": csvf}},
+                {"name": "s3", "dummy": "x", "sink": {"sqlite": dbf, "table": "t1"}},
+            ])
+            drv.finish()
+            with open(jsonl) as f:
+                recs = [json.loads(x) for x in f]
+            self.assertEqual([x["loop"] for x in recs], [0, 1, 2])
+            self.assertEqual([x["result"]["value"] for x in recs], ["a", "b", "c"])
+            self.assertEqual(recs[0]["name"], "s1")
+            with open(csvf) as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual([x["value"] for x in rows], ["a", "b"])
+            db = sqlite3.connect(dbf)
+            rows = db.execute("SELECT name, result FROM t1").fetchall()
+            db.close()
+            self.assertEqual(rows, [("s3", '{"value": "x"}')])
+        with self.assertRaisesRegex(Exception, "unknown sink"):
+            drv.run([{"name": "s4", "dummy": "x", "sink": "out.txt"}])
+
+    def test_sink_csv_columns(self):
+        with tempfile.TemporaryDirectory() as td:
+            csvf = os.path.join(td, "out.csv")
+            snk = sink.CsvSink(csvf)
+            snk.write({"name": "s1", "result": {"a": 1}})
+            snk.write({"name": "s2", "result": {"a": 2, "b": 3}})
+            snk.close()
+            with open(csvf) as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual([x["a"] for x in rows], ["1", "2"])
+            self.assertEqual([x["extra"] for x in rows], ["", '{"b": 3}'])
+            # append to file written by other columns order
+            with open(csvf, "w") as f:
+                f.write("a,name\n0,s0\n")
+            snk = sink.CsvSink(csvf)
+            with self.assertLogs(snk.log, "WARNING"):
+                snk.write({"name": "s1", "result": {"b": 1, "a": 1}})
+            snk.close()
+            with open(csvf) as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(rows, [["a", "name"], ["0", "s0"], ["1", "s1"]])
+
+    def test_sink_sqlite_batch(self):
+        with tempfile.TemporaryDirectory() as td:
+            dbf = os.path.join(td, "out.db")
+
+            def committed():
+                db = sqlite3.connect(dbf)
+                try:
+                    return db.execute("SELECT count(*) FROM results").fetchone()[0]
+                finally:
+                    db.close()
+            snk = sink.SqliteSink(dbf, flush=2, interval=None)
+            for i in range(3):
+                snk.write({"name": "s%d" % (i), "result": i})
+            self.assertEqual(committed(), 2)
+            snk.close()
+            self.assertEqual(committed(), 3)
+            # default: batched, committed by time
+            snk = sink.SqliteSink(dbf)
+            snk.write({"name": "x"})
+            self.assertEqual(committed(), 3)
+            snk.last_flush -= 2
+            snk.write({"name": "y"})
+            self.assertEqual(committed(), 5)
+            snk.close()
+            snk = sink.SqliteSink(dbf, flush=1)
+            snk.write({"name": "z"})
+            self.assertEqual(committed(), 6)
+            snk.close()
+
+    def test_load_file(self):
+        cls = cli.loadmodules("dummy", [])
+        drv = cls()
+        with tempfile.TemporaryDirectory() as td:
+            fn = os.path.join(td, "cred.json")
+            with open(fn, "w") as f:
+                json.dump({"user": {"name": "u1", "tags": ["a"]}}, f)
+            param = {"json": {"file": fn, "path": "user"}}
+            v1 = drv.getvalue(param)
+            v1["tags"].append("b")  # result is a copy
+            self.assertEqual(drv.getvalue(param), {"name": "u1", "tags": ["a"]})
+            self.assertIs(drv.load_file("json", fn), drv.load_file("json", fn))
+            drv.do_var_from({"json": fn})
+            self.assertEqual(drv.variables["user"]["name"], "u1")
+            with open(fn, "w") as f:
+                json.dump({"user": {"name": "user2"}}, f)
+            self.assertEqual(drv.getvalue({"json": {"file": fn, "path": "user.name"}}), "user2")
@@ -1,7 +1,13 @@
+import io
 import os
+import re
+import json
 import unittest
 import tempfile
-from unittest.mock import MagicMock
+import zipfile
+from unittest.mock import MagicMock, PropertyMock
+from selenium.common.exceptions import WebDriverException
+from PIL import Image
 from selenible import cli
 
 
@@ -50,9 +56,114 @@ class TestBrowser(unittest.TestCase):
         tfa = tempfile.NamedTemporaryFile(suffix=".tar")
         os.unlink(tfa.name)
         drv.do_screenshot({"archive": tfa.name})
+        drv.finish()
         st = os.stat(tfa.name)
         self.assertNotEqual(st.st_size, 0)
 
+    def test_screenshot_inmemory(self):
+        _, drv = self.dummy()
+        with tempfile.TemporaryDirectory() as td:
+            out = os.path.join(td, "shot.png")
+            drv.do_screenshot({"output": out, "crop": [0, 0, 4, 4], "resize": [8, 6]})
+            self.assertEqual(Image.open(out).size, (8, 6))
+            arc = os.path.join(td, "shots.zip")
+            out2 = os.path.join(td, "shot2.png")
+            drv.do_screenshot({"output": out2, "archive": arc})
+            out3 = os.path.join(td, "shot3.png")
+            drv.do_screenshot({"output": out3, "archive": arc, "optimize": "background"})
+            drv.finish()
+            self.assertFalse(os.path.exists(out2))
+            self.assertFalse(os.path.exists(out3))
+            with zipfile.ZipFile(arc) as zf:
+                self.assertEqual(len(zf.namelist()), 2)
+
+    def test_screenshot_dedup(self):
+        _, drv = self.dummy()
+        with tempfile.TemporaryDirectory() as td:
+            manifest = os.path.join(td, "manifest.jsonl")
+            out1 = os.path.join(td, "shot1.png")
+            out2 = os.path.join(td, "shot2.png")
+            res1 = drv.do_screenshot({"output": out1, "dedup": 0, "manifest": manifest, "label": "s1"})
+            res2 = drv.do_screenshot({"output": out2, "dedup": 0, "manifest": manifest, "label": "s2"})
+            drv.finish()
+            self.assertEqual(res1, out1)
+            self.assertEqual(res2, out1)
+            self.assertFalse(os.path.exists(out2))
+            with open(manifest) as f:
+                recs = [json.loads(x) for x in f]
+            self.assertEqual([x["name"] for x in recs], ["s1", "s2"])
+            self.assertEqual([x["result"]["duplicate"] for x in recs], [False, True])
+
+    def test_screenshot_manifest(self):
+        _, drv = self.dummy()
+        with tempfile.TemporaryDirectory() as td:
+            manifest = os.path.join(td, "manifest.jsonl")
+            drv.save_every = True
+            drv.save_manifest = manifest
+            cwd = os.getcwd()
+            os.chdir(td)
+            try:
+                drv.run([{"name": "s1", "echo": "a"}, {"name": "s2", "echo": "b"}])
+                drv.finish()
+            finally:
+                os.chdir(cwd)
+            with open(manifest) as f:
+                recs = [json.loads(x) for x in f]
+            self.assertEqual([x["name"] for x in recs], ["s1", "s2"])
+            self.assertTrue(all([os.path.exists(os.path.join(td, x["result"]["image"])) for x in recs]))
+
+    def test_screenshot_element(self):
+        _, drv = self.dummy()
+        buf = io.BytesIO()
+        Image.new("RGB", (20, 10)).save(buf, format="png")
+        elem1 = MagicMock()
+        elem1.screenshot_as_png = buf.getvalue()
+        elem2 = MagicMock()
+        elem2.screenshot_as_png = buf.getvalue()
+        drv.driver.find_elements = MagicMock(return_value=[elem1, elem2])
+        drv.driver.get_screenshot_as_png = MagicMock()
+        with tempfile.TemporaryDirectory() as td:
+            out = os.path.join(td, "elem.png")
+            res = drv.do_screenshot({"output": out, "tag": "img", "all": True})
+            self.assertEqual(res, [os.path.join(td, "elem_0.png"), os.path.join(td, "elem_1.png")])
+            self.assertEqual(Image.open(res[1]).size, (20, 10))
+            drv.driver.get_screenshot_as_png.assert_not_called()
+
+    def test_screenshot_element_fallback(self):
+        _, drv = self.dummy()
+        buf = io.BytesIO()
+        Image.new("RGB", (100, 100)).save(buf, format="png")
+        elem = MagicMock()
+        type(elem).screenshot_as_png = PropertyMock(side_effect=WebDriverException("unknown command"))
+        elem.location = {"x": 10, "y": 20}
+        elem.size = {"width": 30, "height": 5}
+        drv.driver.find_elements = MagicMock(return_value=[elem])
+        drv.driver.get_screenshot_as_png = MagicMock(return_value=buf.getvalue())
+        with tempfile.TemporaryDirectory() as td:
+            out = os.path.join(td, "elem.png")
+            res = drv.do_screenshot({"output": out, "id": "element1"})
+            self.assertEqual(res, out)
+            self.assertEqual(Image.open(out).size, (30, 5))
+            self.assertFalse(drv.element_screenshot)
+
+    def test_screenshot_element_error(self):
+        _, drv = self.dummy()
+        buf = io.BytesIO()
+        Image.new("RGB", (100, 100)).save(buf, format="png")
+        elem1 = MagicMock()
+        type(elem1).screenshot_as_png = PropertyMock(side_effect=WebDriverException("element is stale"))
+        elem1.location = {"x": 10, "y": 20}
+        elem1.size = {"width": 30, "height": 5}
+        elem2 = MagicMock()
+        elem2.screenshot_as_png = buf.getvalue()
+        drv.driver.find_elements = MagicMock(return_value=[elem1, elem2])
+        drv.driver.get_screenshot_as_png = MagicMock(return_value=buf.getvalue())
+        with tempfile.TemporaryDirectory() as td:
+            res = drv.do_screenshot({"output": os.path.join(td, "elem.png"), "tag": "img", "all": True})
+            self.assertEqual(Image.open(res[0]).size, (30, 5))
+            self.assertEqual(Image.open(res[1]).size, (100, 100))
+            self.assertTrue(drv.element_screenshot)
+
     def test_click(self):
         _, drv = self.dummy()
         elem = MagicMock()
@@ -170,3 +281,38 @@ class TestBrowser(unittest.TestCase):
 
         drv.do_switch(True)
         drv.driver.switch_to_default_content.assert_called_once()
+
+    def test_screenshot_fullpage(self):
+        _, drv = self.dummy()
+        # 80x1000 (CSS pixel) page, devicePixelRatio=2, viewport height=300, fixed header=30
+        page = Image.new("RGB", (160, 2000))
+        page.putdata([(y % 256, y // 256, x) for y in range(2000) for x in range(160)])
+        state = {"y": 0}
+
+        def execute_script(script, *args):
+            if script.startswith("return [window.pageXOffset"):
+                return [0, state["y"], 1000, 300, 2]
+            if "getComputedStyle" in script:
+                return 30
+            m = re.match(r"window.scrollTo\(([^,]+),([^)]+)\)", script)
+            state["y"] = min(int(m.group(2)), 1000 - 300)
+            return state["y"]
+
+        def screenshot():
+            img = page.crop((0, state["y"] * 2, 160, (state["y"] + 300) * 2))
+            img.paste((255, 255, 255), (0, 0, 160, 60))
+            buf = io.BytesIO()
+            img.save(buf, format="png")
+            return buf.getvalue()
+        drv._driver = MagicMock()
+        drv._driver.execute_script.side_effect = execute_script
+        drv._driver.get_screenshot_as_png.side_effect = screenshot
+        with tempfile.TemporaryDirectory() as td:
+            out = os.path.join(td, "page.png")
+            self.assertEqual(drv.do_screenshot({"output": out, "fullpage": True, "header": "auto"}), out)
+            expected = page.copy()
+            expected.paste((255, 255, 255), (0, 0, 160, 60))
+            self.assertEqual(Image.open(out).tobytes(), expected.tobytes())
+            self.assertEqual(drv._driver.get_screenshot_as_png.call_count, 4)
+            with self.assertRaises(Exception):
+                drv.do_screenshot({"output": out, "fullpage": True, "header": 300})
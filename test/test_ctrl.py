@@ -1,13 +1,101 @@
 import io
+import os
+import re
 import time
 import json
 import yaml
 import toml
 import unittest
+import tempfile
+import threading
+import socketserver
+import http.server
 from unittest.mock import patch, MagicMock
 from selenible import cli
 
 
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer is python 3.7+
+    daemon_threads = True
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    """serve class variable files. supports Range and keep-alive"""
+    protocol_version = "HTTP/1.1"
+    files = {}
+    connections = 0
+    requests = []
+    active = 0
+    max_active = 0
+    delay = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        FileHandler.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.lock:
+            FileHandler.requests.append((self.path, dict(self.headers)))
+            FileHandler.active += 1
+            FileHandler.max_active = max(FileHandler.max_active, FileHandler.active)
+        try:
+            time.sleep(self.delay)
+            self.get1()
+        finally:
+            with self.lock:
+                FileHandler.active -= 1
+
+    def get1(self):
+        data = self.files.get(self.path.split("?")[0])
+        if data is None:
+            self.send_response(404)
+            self.send_header("content-length", "0")
+            self.end_headers()
+            return
+        etag = '"%d"' % (hash(data))
+        if self.headers.get("if-none-match") == etag:
+            self.send_response(304)
+            self.send_header("content-length", "0")
+            self.end_headers()
+            return
+        m = re.match(r"bytes=(\d+)-", self.headers.get("range", ""))
+        if m:
+            start = int(m.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("content-length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("content-range", "bytes %d-%d/%d" % (start, len(data) - 1, len(data)))
+            data = data[start:]
+        else:
+            self.send_response(200)
+        self.send_header("etag", etag)
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FileServer:
+    def __enter__(self):
+        FileHandler.connections = 0
+        FileHandler.requests = []
+        FileHandler.max_active = 0
+        self.srv = ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+        self.th = threading.Thread(target=self.srv.serve_forever, daemon=True)
+        self.th.start()
+        return "http://127.0.0.1:%d" % (self.srv.server_address[1])
+
+    def __exit__(self, *args):
+        self.srv.shutdown()
+        self.srv.server_close()
+
+
 class TestCtrl(unittest.TestCase):
     def dotest(self, param, expected=None, **kwargs):
         cls = cli.loadmodules("dummy", [])
@@ -191,3 +279,119 @@ class TestCtrl(unittest.TestCase):
             text: hello
           register: v1
         """, "hello", v1="hello")
+
+    def test_download(self):
+        cls = cli.loadmodules("dummy", [])
+        drv = cls()
+        FileHandler.files = {"/a.bin": bytes(range(256)) * 1000, "/b.json": b'{"a": 1}'}
+        with FileServer() as url, tempfile.TemporaryDirectory() as td:
+            out = os.path.join(td, "a.bin")
+            drv.variables["cookies"] = [{"name": "c1", "value": "v1"}]
+            self.assertEqual(drv.do_download({"url": url + "/b.json", "json": True}), {"a": 1})
+            self.assertEqual(drv.do_download({"url": url + "/a.bin", "output": out, "chunk": 1000}), out)
+            with open(out, "rb") as f:
+                self.assertEqual(f.read(), FileHandler.files["/a.bin"])
+            self.assertEqual(FileHandler.connections, 1)
+            self.assertEqual(FileHandler.requests[-1][1].get("Cookie"), "c1=v1")
+            # resume
+            with open(out, "r+b") as f:
+                f.truncate(1000)
+            drv.do_download({"url": url + "/a.bin", "output": out, "resume": True})
+            self.assertEqual(FileHandler.requests[-1][1].get("Range"), "bytes=1000-")
+            with open(out, "rb") as f:
+                self.assertEqual(f.read(), FileHandler.files["/a.bin"])
+            drv.do_download({"url": url + "/a.bin", "output": out, "resume": True})
+            self.assertEqual(os.stat(out).st_size, 256000)
+            with self.assertRaisesRegex(Exception, "status 404"):
+                drv.do_download({"url": url + "/notfound.json", "output": os.path.join(td, "x.json"),
+                                 "json": True})
+            drv.finish()
+            self.assertIsNone(drv.http)
+
+    def test_download_bulk(self):
+        cls = cli.loadmodules("dummy", [])
+        drv = cls()
+        FileHandler.files = {"/f%d.bin" % (i): b"x" * (i + 1) for i in range(8)}
+        FileHandler.delay = 0.05
+        try:
+            with FileServer() as url, tempfile.TemporaryDirectory() as td:
+                drv.variables["urls"] = [url + "/f%d.bin" % (i) for i in range(7)] + [url + "/notfound.bin"]
+                res = drv.do_download({"items": "urls", "output": os.path.join(td, "out"),
+                                       "workers": 4, "per_host": 2})
+                self.assertEqual([x["status"] for x in res], [200] * 7 + [404])
+                self.assertEqual([x["size"] for x in res[:7]], list(range(1, 8)))
+                self.assertEqual(sorted(os.listdir(os.path.join(td, "out"))), ["f%d.bin" % (i) for i in range(7)])
+                self.assertEqual(FileHandler.max_active, 2)
+                res = drv.do_download({"items": [[url + "/f7.bin", os.path.join(td, "f7.bin")]]})
+                self.assertEqual(res[0]["output"], os.path.join(td, "f7.bin"))
+                self.assertEqual(os.stat(res[0]["output"]).st_size, 8)
+                # same basename: unique output
+                res = drv.do_download({"items": [url + "/", url + "/?a=1", url + "/f1.bin", url + "/x/f1.bin"],
+                                       "output": os.path.join(td, "out3")})
+                self.assertEqual([os.path.basename(x["output"]) for x in res],
+                                 ["index.html", "index_1.html", "f1.bin", "f1_1.bin"])
+                with self.assertRaisesRegex(Exception, "duplicate output"):
+                    drv.do_download({"items": [[url + "/f1.bin", "a.bin"], [url + "/f2.bin", "./a.bin"]]})
+                # other host is not blocked by busy host
+                FileHandler.requests = []
+                other = url.replace("127.0.0.1", "localhost")
+                items = [url + "/f%d.bin" % (i) for i in range(6)] + [other + "/f6.bin", other + "/f7.bin"]
+                res = drv.do_download({"items": items, "output": os.path.join(td, "out2"), "workers": 4,
+                                       "per_host": 2})
+                self.assertEqual([x["status"] for x in res], [200] * 8)
+                hosts = [x[1].get("Host").split(":")[0] for x in FileHandler.requests]
+                self.assertIn("localhost", hosts[:4])
+        finally:
+            FileHandler.delay = 0
+            drv.finish()
+
+    def test_download_cache(self):
+        cls = cli.loadmodules("dummy", [])
+        drv = cls()
+        FileHandler.files = {"/report.csv": b"a,b\n1,2\n" * 100}
+        with FileServer() as url, tempfile.TemporaryDirectory() as td:
+            out = os.path.join(td, "report.csv")
+            param = {"url": url + "/report.csv", "output": out, "cache": os.path.join(td, "cache.db")}
+            drv.do_download(param)
+            drv.do_download(param)
+            self.assertNotIn("If-None-Match", FileHandler.requests[0][1])
+            self.assertIn("If-None-Match", FileHandler.requests[1][1])
+            self.assertEqual(drv.summary["download"], {"requests": 2, "miss": 1, "hit": 1, "bytes": 800, "saved": 800})
+            # modified locally: download again
+            with open(out, "a") as f:
+                f.write("x")
+            drv.do_download(param)
+            self.assertNotIn("If-None-Match", FileHandler.requests[-1][1])
+            with open(out, "rb") as f:
+                self.assertEqual(f.read(), FileHandler.files["/report.csv"])
+            drv.finish()
+
+    def test_xslt(self):
+        cls = cli.loadmodules("dummy", [])
+        drv = cls()
+        drv.driver.page_source = ("<html><body><div class='item x'><a href='1'>a</a></div>"
+                                  "<div class='item'><a href='2'>b</a></div><p><a href='3'>c</a></p></body></html>")
+        proc = """<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+          <xsl:output method="text"/>
+          <xsl:template match="/"><xsl:for-each select="//a"><xsl:value-of select="@href"/></xsl:for-each>
+          </xsl:template></xsl:stylesheet>"""
+        from selenible.modules import ctrl
+        ctrl.compile_xslt.cache_clear()
+        self.assertEqual(drv.do_xslt({"proc": proc}), ["123"])
+        self.assertEqual(drv.do_xslt({"proc": proc, "class": "item"}), ["1", "2"])
+        self.assertEqual(drv.do_xslt({"proc": proc, "xpath": "//p"}), ["3"])
+        self.assertEqual(ctrl.compile_xslt.cache_info().misses, 1)
+        self.assertEqual(ctrl.compile_xslt.cache_info().hits, 2)
+        # css selector without cssselect: elements from browser
+        elems = [MagicMock(), MagicMock()]
+        elems[0].get_attribute = MagicMock(return_value="<div class='item x'><a href='1'>a</a></div>")
+        elems[1].get_attribute = MagicMock(return_value="<div class='item'><a href='2'>b</a></div>")
+        drv.driver.find_elements = MagicMock(return_value=elems)
+        with patch("selenible.drivers.base.CSSSelector", None):
+            self.assertEqual(drv.do_xslt({"proc": proc, "select": "div.item"}), ["1", "2"])
+        elems[0].get_attribute.assert_called_once_with("outerHTML")
+        with tempfile.TemporaryDirectory() as td:
+            fn = os.path.join(td, "a.xsl")
+            with open(fn, "w") as f:
+                f.write(proc)
+            self.assertEqual(drv.do_xslt({"proc_file": fn, "tag": "div"}), ["1", "2"])
@@ -0,0 +1,298 @@
+import os
+import time
+import numpy
+import tarfile
+import zipfile
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+from PIL import Image, ImageDraw
+from selenible import cli
+from selenible.modules import imageproc
+
+
+class TestImageproc(unittest.TestCase):
+    def dummy(self):
+        cls = cli.loadmodules("dummy", ["imageproc"])
+        return cls, cls()
+
+    def test_autocrop_box(self):
+        img = Image.new("RGB", (300, 1000), "white")
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((20, 500, 40, 700), fill="black")
+        draw.point((250, 900), fill=(200, 200, 200))  # within tolerance
+        self.assertEqual(imageproc.autocrop_box(img), (20, 500, 41, 701))
+        self.assertEqual(imageproc.autocrop_box(img, tolerance=10), (20, 500, 251, 901))
+        self.assertIsNone(imageproc.autocrop_box(Image.new("RGBA", (10, 10), "red")))
+        self.assertEqual(imageproc.autocrop_box(img.convert("L"), band=7), (20, 500, 41, 701))
+
+    def test_diff_bands(self):
+        img1 = Image.new("RGB", (50, 300), (10, 20, 30))
+        img2 = img1.copy()
+        img2.putpixel((5, 200), (0, 40, 30))
+        res = {y: d for y, d in imageproc.diff_bands(img1, img2, band=100)}
+        self.assertEqual(sorted(res.keys()), [0, 100, 200])
+        self.assertFalse(res[100].any())
+        self.assertEqual(res[200][0, 5].tolist(), [10, 20, 0])
+
+    def test_image_crop(self):
+        _, drv = self.dummy()
+        img = Image.new("RGBA", (100, 100), "white")
+        ImageDraw.Draw(img).rectangle((10, 20, 29, 49), fill="blue")
+        with tempfile.TemporaryDirectory() as td:
+            fn = os.path.join(td, "input.png")
+            out = os.path.join(td, "output.png")
+            img.save(fn)
+            drv.do_image_crop({"input": fn, "output": out, "size": "auto"})
+            self.assertEqual(Image.open(out).size, (20, 30))
+            drv.do_image_crop({"input": fn, "output": out, "size": [0, 0, 5, 6]})
+            self.assertEqual(Image.open(out).size, (5, 6))
+
+    def test_image_compare(self):
+        _, drv = self.dummy()
+        base = Image.new("RGB", (200, 150), "white")
+        ImageDraw.Draw(base).text((10, 10), "hello", fill="black")
+        changed = base.copy()
+        ImageDraw.Draw(changed).rectangle((100, 100, 149, 119), fill="red")
+        with tempfile.TemporaryDirectory() as td:
+            for d in ("base", "shot"):
+                os.mkdir(os.path.join(td, d))
+            base.save(os.path.join(td, "base", "a.png"))
+            base.save(os.path.join(td, "shot", "a.png"))
+            base.save(os.path.join(td, "base", "b.png"))
+            changed.save(os.path.join(td, "shot", "b.png"))
+            res = drv.do_image_compare({"input": os.path.join(td, "shot", "a.png"),
+                                        "baseline": os.path.join(td, "base", "a.png")})
+            self.assertAlmostEqual(res["score"], 1.0)
+            self.assertEqual(res["changed"], 0)
+            heat = os.path.join(td, "heat.png")
+            res = drv.do_image_compare({"input": os.path.join(td, "shot", "b.png"),
+                                        "baseline": os.path.join(td, "base", "b.png"),
+                                        "output": heat, "threshold": 0.99})
+            self.assertLess(res["score"], 0.99)
+            self.assertFalse(res["passed"])
+            self.assertAlmostEqual(res["changed"], 50 * 20 / (200 * 150))
+            self.assertEqual(Image.open(heat).getpixel((120, 110))[0], 255)
+            res = drv.do_image_compare({"input": os.path.join(td, "shot", "b.png"),
+                                        "baseline": os.path.join(td, "base", "b.png"),
+                                        "ignore": [[90, 90, 160, 130]]})
+            self.assertAlmostEqual(res["score"], 1.0)
+            res = drv.do_image_compare({"input": os.path.join(td, "shot"), "baseline": os.path.join(td, "base"),
+                                        "output": os.path.join(td, "diff"), "workers": 2})
+            self.assertEqual([os.path.basename(x["input"]) for x in res], ["a.png", "b.png"])
+            self.assertTrue(os.path.exists(os.path.join(td, "diff", "b.png")))
+
+    def test_image_archive(self):
+        _, drv = self.dummy()
+        with tempfile.TemporaryDirectory() as td:
+            names = []
+            for i in range(3):
+                fn = os.path.join(td, "img%d.png" % (i))
+                Image.new("RGB", (10, 10), "white").save(fn)
+                names.append(fn)
+            zipfn = os.path.join(td, "out.zip")
+            tgzfn = os.path.join(td, "out.tar.gz")
+            for fn in names:
+                drv.do_image_archive({"input": fn, "output": zipfn, "delete": False})
+            drv.do_image_archive({"output": zipfn, "close": True})
+            with zipfile.ZipFile(zipfn) as zf:
+                self.assertEqual(len(zf.namelist()), 3)
+            for fn in names:
+                drv.do_image_archive({"input": fn, "output": tgzfn, "compress": 9})
+            self.assertEqual(list(drv.archives.keys()), [tgzfn])
+            drv.finish()
+            self.assertEqual(drv.archives, {})
+            with tarfile.open(tgzfn) as tf:
+                self.assertEqual(len(tf.getnames()), 3)
+            self.assertFalse(os.path.exists(names[0]))
+
+    def test_image_archive_absolute(self):
+        with tempfile.TemporaryDirectory() as td:
+            fn = os.path.join(td, "a.png")
+            Image.new("RGB", (10, 10), "white").save(fn)
+            for ext in ("zip", "tar"):
+                arc = imageproc.archivewriter(os.path.join(td, "out." + ext))
+                arc.add(fn)
+                arc.add(os.path.join(td, "b.png"), data=b"x")
+                arc.close()
+                if ext == "zip":
+                    with zipfile.ZipFile(os.path.join(td, "out.zip")) as zf:
+                        names = zf.namelist()
+                else:
+                    with tarfile.open(os.path.join(td, "out.tar")) as tf:
+                        names = tf.getnames()
+                self.assertEqual(names, [fn.lstrip("/"), os.path.join(td, "b.png").lstrip("/")])
+
+    def test_image_archive_compressed_exists(self):
+        with tempfile.TemporaryDirectory() as td:
+            tgz = os.path.join(td, "out.tar.gz")
+            for i in range(3):
+                arc = imageproc.archivewriter(tgz)
+                arc.add("run%d.txt" % (i), data=b"x")
+                arc.close()
+            self.assertEqual(sorted(os.listdir(td)), ["out.1.tar.gz", "out.2.tar.gz", "out.tar.gz"])
+            with tarfile.open(tgz) as tf:
+                self.assertEqual(tf.getnames(), ["run0.txt"])
+            with tarfile.open(os.path.join(td, "out.2.tar.gz")) as tf:
+                self.assertEqual(tf.getnames(), ["run2.txt"])
+
+    def test_image_archive_error(self):
+        with tempfile.TemporaryDirectory() as td:
+            arc = imageproc.archivewriter(os.path.join(td, "out.zip"))
+            arc.add(os.path.join(td, "notfound.png"))
+            for _ in range(100):
+                if len(arc.errors) != 0:
+                    break
+                time.sleep(0.01)
+            with self.assertRaisesRegex(Exception, "1 entries failed"):
+                arc.add("x.txt", data=b"x")
+            arc.add("y.txt", data=b"y")
+            arc.add(os.path.join(td, "notfound2.png"))
+            with self.assertRaisesRegex(Exception, "notfound2"):
+                arc.close()
+
+    def test_image_optimize(self):
+        _, drv = self.dummy()
+        with tempfile.TemporaryDirectory() as td:
+            img = Image.new("RGB", (200, 200), "white")
+            ImageDraw.Draw(img).rectangle((10, 10, 50, 50), fill="black")
+            fn = os.path.join(td, "input.png")
+            img.save(fn, compress_level=0)
+            before = os.stat(fn).st_size
+            res = drv.do_image_optimize({"input": fn, "output": os.path.join(td, "out.png"),
+                                         "command": "not-installed-optimizer"})
+            self.assertEqual(res["method"], "pillow")
+            self.assertLess(res["after"], before)
+            for i in range(3):
+                img.save(os.path.join(td, "bg%d.png" % (i)), compress_level=0)
+                drv.do_image_optimize({"input": os.path.join(td, "bg%d.png" % (i)), "background": True,
+                                       "workers": 2, "command": "not-installed-optimizer"})
+            # done callback is slower than the optimization itself
+            stat = imageproc.optimize_stat
+            with patch.object(imageproc, "optimize_stat", side_effect=lambda *a: time.sleep(0.2) or stat(*a)):
+                drv.do_image_optimize({"input": os.path.join(td, "bg0.png"), "background": True,
+                                       "command": "not-installed-optimizer"})
+                res = drv.do_image_wait({})
+            self.assertEqual(res["files"], 5)
+            self.assertEqual(drv.optimizer.pending, 0)
+            res = drv.do_image_wait(None)
+            self.assertLess(os.stat(os.path.join(td, "bg2.png")).st_size, before)
+            drv.finish()
+            self.assertEqual(drv.summary, {})
+
+    def test_image_optimize_cache(self):
+        _, drv = self.dummy()
+        with tempfile.TemporaryDirectory() as td:
+            cachedir = os.path.join(td, "cache")
+            img = Image.new("RGB", (200, 200), "white")
+            fn = os.path.join(td, "input.png")
+            img.save(fn, compress_level=0)
+            param = {"input": fn, "output": os.path.join(td, "out.png"), "cache": cachedir,
+                     "command": "not-installed-optimizer"}
+            res1 = drv.do_image_optimize(param)
+            res2 = drv.do_image_optimize(param)
+            self.assertEqual((res1["cache"], res2["cache"]), ("miss", "hit"))
+            self.assertEqual(res1["after"], res2["after"])
+            self.assertEqual(drv.summary["image_optimize"]["hit_rate"], 0.5)
+            # other level is other entry
+            res3 = drv.do_image_optimize(dict(param, level=2))
+            self.assertEqual(res3["cache"], "miss")
+            self.assertEqual(len(os.listdir(cachedir)), 2)
+            # evicted by size
+            imageproc.optcache(cachedir, res1["after"]).evict()
+            self.assertEqual(len(os.listdir(cachedir)), 1)
+
+    def test_image_pipeline(self):
+        _, drv = self.dummy()
+        ops = [
+            {"crop": "auto"},
+            {"resize": {"percent": 50}},
+            {"enhance": [{"Brightness": 1.0}]},
+            {"filter": [{"GaussianBlur": 1}]},
+            {"ops": [{"mirror": []}]},
+            {"convert": "L"},
+            {"writetext": {"text": "x", "color": "black"}},
+        ]
+        with tempfile.TemporaryDirectory() as td:
+            img = Image.new("RGB", (100, 100), "white")
+            ImageDraw.Draw(img).rectangle((10, 20, 49, 59), fill="black")
+            for i in range(3):
+                img.save(os.path.join(td, "in%d.png" % (i)))
+            out = os.path.join(td, "out.png")
+            self.assertEqual(drv.do_image_pipeline({"input": os.path.join(td, "in0.png"), "output": out,
+                                                    "ops": ops}), out)
+            res = Image.open(out)
+            self.assertEqual((res.mode, res.size), ("L", (20, 20)))
+            res = drv.do_image_pipeline({"input": os.path.join(td, "in*.png"), "output": os.path.join(td, "out"),
+                                         "ops": ops, "workers": 2})
+            self.assertEqual([os.path.basename(x) for x in res], ["in0.png", "in1.png", "in2.png"])
+            self.assertEqual(Image.open(res[2]).size, (20, 20))
+            with self.assertRaises(Exception):
+                drv.do_image_pipeline({"input": out, "ops": [{"unknown": 1}]})
+
+    def test_image_writetext(self):
+        _, drv = self.dummy()
+        with tempfile.TemporaryDirectory() as td:
+            fn = os.path.join(td, "input.png")
+            Image.new("RGB", (100, 100), "white").save(fn)
+            imageproc.load_font.cache_clear()
+            drv.do_image_writetext({"input": fn, "text": "hello", "color": "black", "position": [0, 0]})
+            drv.do_image_writetext({"input": fn, "color": "blue", "items": [
+                "top", {"text": "bottom", "position": [0, 80], "color": "red"}]})
+            self.assertEqual(imageproc.load_font.cache_info().misses, 1)
+            self.assertEqual(imageproc.load_font.cache_info().hits, 2)
+            img = Image.open(fn)
+            self.assertEqual(img.getpixel((50, 50)), (255, 255, 255))
+            colors = {x[1] for x in img.getcolors(100 * 100)}
+            self.assertTrue(any([r < 128 and g < 128 and b < 128 for r, g, b in colors]))
+            self.assertTrue(any([b - r > 128 for r, g, b in colors]))
+            self.assertTrue(any([r - b > 128 for r, g, b in colors]))
+            drv.runcmd = MagicMock(return_value="from pipe\n")
+            drv.do_image_writetext({"input": fn, "pipe": "echo from pipe"})
+            drv.do_image_writetext({"input": fn, "items": [{"pipe": "echo 1"}, {"text": "x"}, "y"]})
+            self.assertEqual(drv.runcmd.call_count, 2)
+            self.assertEqual(imageproc.text_items({"pipe": "p", "size": 5, "items": ["a", {"position": [1, 1]}]}),
+                             [{"text": "a", "size": 5}, {"pipe": "p", "size": 5, "position": [1, 1]}])
+
+    def test_pngreader(self):
+        rng = numpy.random.default_rng(1)
+        with tempfile.TemporaryDirectory() as td:
+            fn = os.path.join(td, "input.png")
+            out = os.path.join(td, "output.png")
+            for mode in ("RGB", "RGBA", "L", "LA", "P"):
+                img = Image.fromarray(rng.integers(0, 255, (300, 50, 3), dtype=numpy.uint8)).convert(mode)
+                img.save(fn)
+                rd = imageproc.pngreader(fn)
+                self.assertEqual(imageproc.vstack(list(rd.bands(77))).tobytes(), img.tobytes())
+                if mode == "P":
+                    continue
+                wr = imageproc.pngwriter(out, 50, 300, mode)
+                for band in imageproc.open_bands(fn, 33)[3]:
+                    wr.write(band)
+                wr.close()
+                self.assertEqual(Image.open(out).tobytes(), img.tobytes())
+
+    def test_image_filter_tiled(self):
+        _, drv = self.dummy()
+        rng = numpy.random.default_rng(1)
+        img = Image.fromarray(rng.integers(0, 255, (500, 60, 3), dtype=numpy.uint8))
+        with tempfile.TemporaryDirectory() as td:
+            fn = os.path.join(td, "input.png")
+            out = os.path.join(td, "output.png")
+            img.save(fn)
+            filters = [{"GaussianBlur": 2}, {"MedianFilter": 3}, {"SMOOTH": None}]
+            drv.do_image_filter({"input": fn, "output": out, "filter": filters, "tiled": 40})
+            full = imageproc.filter_image(img, filters)
+            self.assertEqual(Image.open(out).tobytes(), full.tobytes())
+            drv.do_image_enhance({"input": fn, "output": out, "filter": [{"Sharpness": 2.0}], "memory": "256K"})
+            self.assertEqual(Image.open(out).tobytes(), imageproc.enhance_image(img, [{"Sharpness": 2.0}]).tobytes())
+            with self.assertRaises(Exception):
+                drv.do_image_enhance({"input": fn, "output": out, "filter": [{"Contrast": 2.0}], "tiled": True})
+            with self.assertRaises(Exception):
+                drv.do_image_filter({"input": fn, "output": out, "filter": filters, "memory": 1000})
+            drv.do_image_chops({"input": fn, "output": out, "filter": [{"darker": fn}], "tiled": 64})
+            self.assertEqual(Image.open(out).tobytes(), img.tobytes())
+            # null argument: filter's default radius
+            for filters in ([{"GaussianBlur": None}], [{"UnsharpMask": None}], [{"BoxBlur": 5}]):
+                drv.do_image_filter({"input": fn, "output": out, "filter": filters, "tiled": 40})
+                self.assertEqual(Image.open(out).tobytes(), imageproc.filter_image(img, filters).tobytes(), filters)
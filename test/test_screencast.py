@@ -0,0 +1,286 @@
+import io
+import os
+import json
+import base64
+import time
+import tempfile
+import unittest
+import itertools
+from unittest.mock import MagicMock, patch
+from PIL import Image
+from selenible import cli
+from selenible.modules import screencast
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class TestScreencast(unittest.TestCase):
+    def dummy(self):
+        cls = cli.loadmodules("dummy", ["screencast"])
+        return cls, cls()
+
+    def frames(self, colors):
+        res = []
+        for c in colors:
+            buf = io.BytesIO()
+            Image.new("RGB", (20, 20), c).save(buf, format="png")
+            res.append(buf.getvalue())
+        return res
+
+    def test_screencast(self):
+        _, drv = self.dummy()
+        frames = self.frames(["red", "blue"])
+        cnt = itertools.count()
+        drv.saveshot = MagicMock(side_effect=lambda: frames[next(cnt) % 2])
+        with tempfile.TemporaryDirectory() as td:
+            out = os.path.join(td, "cast.gif")
+            tsfn = os.path.join(td, "cast.json")
+            self.assertEqual(drv.do_screencast({"interval": 0.05, "thumbnail": [10, 10]}), "started")
+            time.sleep(0.3)
+            self.assertEqual(drv.do_screencast({"output": out, "timestamps": tsfn}), "finished")
+            with open(tsfn) as f:
+                ts = json.load(f)
+            self.assertGreater(len(ts), 1)
+            self.assertEqual(ts[0]["frame"], 0)
+            img = Image.open(out)
+            self.assertEqual(img.n_frames, len(ts))
+
+    def test_screencast_notstarted(self):
+        _, drv = self.dummy()
+        with self.assertRaisesRegex(Exception, "not working"):
+            drv.do_screencast("output.gif")
+
+    def test_screencast_dedup(self):
+        _, drv = self.dummy()
+        frames = self.frames(["red", "red", "red", "blue", "blue", "green"])
+        cnt = itertools.count()
+        drv.saveshot = MagicMock(side_effect=lambda: frames[min(next(cnt), len(frames) - 1)])
+        with tempfile.TemporaryDirectory() as td:
+            out = os.path.join(td, "cast.png")
+            tsfn = os.path.join(td, "cast.json")
+            drv.do_screencast({"interval": 0.05})
+            time.sleep(0.5)
+            drv.do_screencast({"output": out, "timestamps": tsfn})
+            with open(tsfn) as f:
+                ts = json.load(f)
+            self.assertEqual(len(ts), 3)
+            # red frame lasts about 3 intervals
+            self.assertGreater(ts[0]["duration"], ts[1]["duration"])
+            self.assertAlmostEqual(ts[1]["timestamp"] - ts[0]["timestamp"], ts[0]["duration"] / 1000)
+
+    def test_devtools(self):
+        _, drv = self.dummy()
+        frames = self.frames(["red", "blue", "blue"])
+        msgs = [json.dumps({"method": "Page.frameNavigated"})]
+        now = time.time()
+        for i, f in enumerate(frames):
+            msgs.append(json.dumps({"method": "Page.screencastFrame", "params": {
+                "data": base64.b64encode(f).decode("ascii"), "sessionId": i,
+                "metadata": {"timestamp": now + i * 0.01}}}))
+
+        def recv():
+            time.sleep(0.01)
+            if len(msgs) != 0:
+                return msgs.pop(0)
+            return "{}"
+        ws = MagicMock()
+        ws.recv = MagicMock(side_effect=recv)
+        drv.devtools_websocket = MagicMock(return_value="ws://localhost:9222/devtools/page/1")
+        with patch("selenible.modules.screencast.websocket") as wsmod, tempfile.TemporaryDirectory() as td:
+            wsmod.create_connection = MagicMock(return_value=ws)
+            out = os.path.join(td, "cast.gif")
+            tsfn = os.path.join(td, "cast.json")
+            drv.do_screencast({"thumbnail": [10, 10]})
+            time.sleep(0.3)
+            drv.do_screencast({"output": out, "timestamps": tsfn})
+            with open(tsfn) as f:
+                ts = json.load(f)
+        self.assertEqual([x["timestamp"] for x in ts], [now, now + 0.01])
+        sent = [json.loads(x[0][0]) for x in ws.send.call_args_list]
+        methods = [x["method"] for x in sent]
+        self.assertEqual(methods[0], "Page.startScreencast")
+        self.assertEqual(sent[0]["params"]["maxWidth"], 10)
+        self.assertEqual(methods.count("Page.screencastFrameAck"), 3)
+        self.assertEqual(methods[-1], "Page.stopScreencast")
+        ws.close.assert_called_once()
+
+    def test_devtools_backpressure(self):
+        _, drv = self.dummy()
+        frames = self.frames(["red", "blue", "green", "yellow", "white"])
+        msgs = [json.dumps({"method": "Page.screencastFrame", "params": {
+            "data": base64.b64encode(f).decode("ascii"), "sessionId": i,
+            "metadata": {"timestamp": 100.0 + i}}}) for i, f in enumerate(frames)]
+
+        def recv():
+            if len(msgs) != 0:
+                return msgs.pop(0)
+            time.sleep(0.01)
+            return "{}"
+        ws = MagicMock()
+        ws.recv = MagicMock(side_effect=recv)
+        acked = []
+
+        def send(data):
+            msg = json.loads(data)
+            if msg["method"] == "Page.screencastFrameAck":
+                # frame is already accepted by the queue
+                acked.append((msg["params"]["sessionId"], screencast.scr_th.seq))
+        ws.send = MagicMock(side_effect=send)
+        drv.devtools_websocket = MagicMock(return_value="ws://localhost:9222/devtools/page/1")
+        add = screencast.framespool.add
+
+        def slowadd(*args):
+            time.sleep(0.1)
+            return add(*args)
+        with patch("selenible.modules.screencast.websocket") as wsmod, tempfile.TemporaryDirectory() as td, \
+                patch.object(screencast.framespool, "add", slowadd):
+            wsmod.create_connection = MagicMock(return_value=ws)
+            tsfn = os.path.join(td, "cast.json")
+            drv.do_screencast({"workers": 1, "queue": 1})
+            for _ in range(100):
+                if len(acked) == len(frames):
+                    break
+                time.sleep(0.05)
+            cast = screencast.scr_th
+            drv.do_screencast({"output": os.path.join(td, "cast.gif"), "timestamps": tsfn})
+            with open(tsfn) as f:
+                ts = json.load(f)
+        self.assertEqual(cast.overrun, 0)
+        self.assertEqual(len(ts), len(frames))
+        self.assertEqual(acked, [(i, i + 1) for i in range(len(frames))])
+
+    def test_screencast_long_gif(self):
+        _, drv = self.dummy()
+        frames = self.frames(["red", "blue"])
+        cnt = itertools.count()
+        drv.saveshot = MagicMock(side_effect=lambda: frames[next(cnt) % 2])
+        with tempfile.TemporaryDirectory() as td:
+            out = os.path.join(td, "cast.gif")
+            drv.do_screencast({"interval": 0.02})
+            time.sleep(0.2)
+            with patch("selenible.modules.screencast.shutil.which", return_value="/usr/bin/ffmpeg"), \
+                    patch("selenible.modules.screencast.subprocess.check_call") as call:
+                drv.do_screencast({"output": out, "pillow_limit": 1})
+            cmd = call.call_args[0][0]
+            self.assertEqual(cmd[0], "ffmpeg")
+            self.assertEqual(cmd[-1], out)
+            self.assertIn("paletteuse", " ".join(cmd))
+            self.assertNotIn("yuv420p", cmd)
+            out = os.path.join(td, "cast.webp")
+            drv.do_screencast({"interval": 0.02})
+            time.sleep(0.2)
+            with patch("selenible.modules.screencast.shutil.which", return_value="/usr/bin/ffmpeg"), \
+                    patch("selenible.modules.screencast.subprocess.check_call") as call:
+                drv.do_screencast({"output": out, "pillow_limit": 1})
+            self.assertIn("libwebp", call.call_args[0][0])
+
+    def test_devtools_not_installed(self):
+        _, drv = self.dummy()
+        drv.devtools_websocket = MagicMock(return_value="ws://localhost:9222/devtools/page/1")
+        drv.saveshot = MagicMock(return_value=self.frames(["red"])[0])
+        with patch("selenible.modules.screencast.websocket", None), tempfile.TemporaryDirectory() as td:
+            with self.assertRaisesRegex(Exception, "websocket-client"):
+                drv.do_screencast({"backend": "devtools"})
+            with self.assertLogs(drv.log, "INFO") as logs:
+                drv.do_screencast({"interval": 0.05})
+            time.sleep(0.1)
+            drv.do_screencast(os.path.join(td, "cast.gif"))
+        self.assertTrue(any(["fallback to polling" in x for x in logs.output]))
+        drv.devtools_websocket.assert_not_called()
+
+    @unittest.skipUnless(resource is not None and os.path.isdir("/proc/self/fd"), "needs rlimit")
+    def test_screencast_many_frames(self):
+        _, drv = self.dummy()
+        cast = screencast.screencast(drv, None)
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        limit = len(os.listdir("/proc/self/fd")) + 64
+        try:
+            for i in range(limit + 50):
+                cast.frames.add(Image.new("RGB", (8, 8), (i % 256, 0, 0)), float(i), i)
+            cast.start_ts, cast.finished_ts = 0.0, float(limit + 50)
+            with tempfile.TemporaryDirectory() as td:
+                out = os.path.join(td, "cast.webp")
+                resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+                try:
+                    cast.savefile(out, encoder="pillow")
+                finally:
+                    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+                self.assertGreater(Image.open(out).n_frames, 1)
+        finally:
+            cast.frames.cleanup()
+
+    def test_screencast_reorder(self):
+        _, drv = self.dummy()
+        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255), (0, 0, 0)]
+        frames = self.frames(colors)
+        cast = screencast.screencast(drv, None, workers=3, queuesize=8)
+        add = screencast.framespool.add
+
+        def slowadd(pool, img, ts, seq, h=None):
+            # earlier frames finish later
+            time.sleep(0.05 * (len(frames) - seq))
+            return add(pool, img, ts, seq, h)
+        try:
+            with patch.object(screencast.framespool, "add", slowadd):
+                for w in cast.workers:
+                    w.start()
+                cast.start_ts = 100.0
+                for i, f in enumerate(frames):
+                    cast.push(f, 100.0 + i)
+                for w in cast.workers:
+                    cast.frameq.put(None)
+                for w in cast.workers:
+                    w.join()
+            cast.finished_ts = 100.0 + len(frames)
+            self.assertNotEqual([x[0] for x in cast.frames.frames], sorted([x[0] for x in cast.frames.frames]))
+            with tempfile.TemporaryDirectory() as td:
+                out = os.path.join(td, "cast.gif")
+                tsfn = os.path.join(td, "cast.json")
+                cast.savefile(out, timestamps=tsfn)
+                with open(tsfn) as f:
+                    self.assertEqual([x["timestamp"] for x in json.load(f)], [100.0 + i for i in range(5)])
+                img = Image.open(out)
+                res = []
+                for i in range(img.n_frames):
+                    img.seek(i)
+                    res.append(img.convert("RGB").getpixel((5, 5)))
+                self.assertEqual(res, colors)
+        finally:
+            cast.frames.cleanup()
+
+    def test_screencast_overrun(self):
+        _, drv = self.dummy()
+        frames = self.frames([(i * 10, 0, 0) for i in range(10)])
+        cnt = itertools.count()
+        drv.saveshot = MagicMock(side_effect=lambda: frames[min(next(cnt), len(frames) - 1)])
+        add = screencast.framespool.add
+
+        def slowadd(*args):
+            time.sleep(0.1)
+            return add(*args)
+        with patch.object(screencast.framespool, "add", slowadd), tempfile.TemporaryDirectory() as td:
+            drv.do_screencast({"interval": 0.001, "workers": 1, "queue": 1})
+            time.sleep(0.5)
+            drv.do_screencast(os.path.join(td, "cast.gif"))
+        summary = drv.summary["screencast"]
+        self.assertGreater(summary["overrun"], 0)
+        self.assertEqual(summary["captured"], summary["frames"] + summary["overrun"] + summary["unchanged"])
+
+    def test_screencast_finish(self):
+        _, drv = self.dummy()
+        drv.saveshot = MagicMock(return_value=self.frames(["red"])[0])
+        drv.do_screencast({"interval": 0.01, "workers": 3})
+        cast = screencast.scr_th
+        time.sleep(0.1)
+        self.assertTrue(all([w.is_alive() for w in cast.workers]))
+        spool = cast.frames.dir
+        drv.finish()
+        self.assertFalse(cast.is_alive())
+        self.assertFalse(any([w.is_alive() for w in cast.workers]))
+        self.assertFalse(os.path.exists(spool))
+        self.assertIsNone(screencast.scr_th)
+        # can start again
+        self.assertEqual(drv.do_screencast({"interval": 0.01}), "started")
+        drv.finish()
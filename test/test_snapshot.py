@@ -0,0 +1,51 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from selenible import cli
+
+
+class TestSnapshot(unittest.TestCase):
+    def dummy(self):
+        cls = cli.loadmodules("dummy", ["snapshot"])
+        drv = cls()
+        drv.driver.page_source = ("<html><head><title>t1</title></head><body>"
+                                  "<div class='item'>hello <b>world</b></div><div class='item'>foo</div></body></html>")
+        drv.driver.find_elements = MagicMock(return_value=[])
+        return drv
+
+    def test_snapshot(self):
+        drv = self.dummy()
+        self.assertEqual(drv.do_snapshot("take"), "http://example.com")
+        self.assertEqual(drv.do_save({"mode": "text", "class": "item"}), ["hello world", "foo"])
+        self.assertEqual(drv.do_save({"mode": "source", "class": "item"}), ["hello <b>world</b>", "foo"])
+        self.assertEqual(drv.do_save({"mode": "source_outer", "tag": "b"}), ["<b>world</b>"])
+        self.assertEqual(drv.do_save({"mode": "title"}), ["t1"])
+        self.assertEqual([x.text for x in drv.do_set({"xpath": "//div", "parseHTML": True})], ["hello ", "foo"])
+        self.assertTrue(drv.eval_param({"exists": {"tag": "b"}}))
+        self.assertTrue(drv.eval_param({"not_exists": {"tag": "i"}}))
+        self.assertTrue(drv.eval_param({"text_contains": {"class": "item", "text": "world"}}))
+        drv.driver.find_elements.assert_not_called()
+        # page moved: read from browser
+        drv.variables["current_url"] = "http://example.com/2"
+        self.assertFalse(drv.eval_param({"exists": {"tag": "b"}}))
+        drv.driver.find_elements.assert_called()
+        self.assertIsNone(drv.dom)
+        drv.do_snapshot("take")
+        self.assertIsNone(drv.do_snapshot("clear"))
+        self.assertIsNone(drv.snapshot_tree())
+
+    def test_snapshot_css_fallback(self):
+        drv = self.dummy()
+        drv.do_snapshot("take")
+        elem = MagicMock()
+        elem.text = "from browser"
+        elem.get_attribute = MagicMock(return_value="<i>x</i>")
+        drv.driver.find_elements = MagicMock(return_value=[elem])
+        with patch("selenible.drivers.base.CSSSelector", None):
+            self.assertEqual(drv.do_save({"mode": "text", "select": "div.item"}), ["from browser"])
+            self.assertEqual(drv.do_save({"mode": "source", "select": "div.item"}), ["<i>x</i>"])
+            self.assertTrue(drv.eval_param({"text_contains": {"select": "div.item", "text": "browser"}}))
+            self.assertEqual([x.tag for x in drv.do_set({"select": "div.item", "parseHTML": True})], ["i"])
+        self.assertEqual(drv.driver.find_elements.call_count, 4)
+        # still answered from snapshot
+        self.assertEqual(drv.do_save({"mode": "title"}), ["t1"])
+        self.assertIsNotNone(drv.dom)
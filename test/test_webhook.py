@@ -0,0 +1,101 @@
+import json
+import time
+import unittest
+import threading
+import socketserver
+import http.server
+from selenible import cli
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer is python 3.7+
+    daemon_threads = True
+
+
+class HookHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    received = []
+    cookies = []
+    connections = 0
+    fail = 0
+    delay = 0
+
+    def setup(self):
+        super().setup()
+        HookHandler.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("content-length"))))
+        time.sleep(self.delay)
+        if HookHandler.fail != 0:
+            HookHandler.fail -= 1
+            self.send_response(503)
+            self.send_header("content-length", "0")
+            self.end_headers()
+            return
+        HookHandler.received.append(body)
+        HookHandler.cookies.append(self.headers.get("cookie"))
+        data = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("set-cookie", "hook=1; Path=/")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TestWebhook(unittest.TestCase):
+    def setUp(self):
+        HookHandler.received = []
+        HookHandler.cookies = []
+        HookHandler.connections = 0
+        HookHandler.fail = 0
+        HookHandler.delay = 0
+        self.srv = ThreadingHTTPServer(("127.0.0.1", 0), HookHandler)
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/hook" % (self.srv.server_address[1])
+        cls = cli.loadmodules("dummy", ["webhook"])
+        self.drv = cls()
+
+    def tearDown(self):
+        self.srv.shutdown()
+        self.srv.server_close()
+
+    def test_sync(self):
+        self.assertEqual(self.drv.do_webhook({"url": self.url, "body": {"a": 1}}), {"ok": True})
+        self.assertEqual(self.drv.do_webhook({"url": self.url, "body": {"a": 2}}), {"ok": True})
+        self.assertEqual(HookHandler.received, [{"a": 1}, {"a": 2}])
+        self.assertEqual(HookHandler.connections, 1)
+
+    def test_background(self):
+        HookHandler.fail = 1
+        for i in range(5):
+            self.assertEqual(self.drv.do_webhook({"url": self.url, "body": {"i": i}, "background": True,
+                                                  "batch": 3, "batch_wait": 0.5, "backoff": 0.01}), "queued")
+        self.drv.finish()
+        self.assertEqual(HookHandler.received, [[{"i": 0}, {"i": 1}, {"i": 2}], [{"i": 3}, {"i": 4}]])
+        self.assertIsNone(self.drv.webhookq)
+
+    def test_drop(self):
+        HookHandler.delay = 0.2
+        for i in range(5):
+            self.drv.do_webhook({"url": self.url, "body": {"i": i}, "background": True, "queue": 1,
+                                 "policy": "drop", "retry": 0})
+        summary = dict(self.drv.summary["webhook"])
+        self.drv.finish()
+        self.assertGreater(summary["dropped"], 0)
+        self.assertEqual(len(HookHandler.received) + summary["dropped"], 5)
+
+    def test_cookies(self):
+        # browser cookies in the download session are not sent, and hook cookies do not come back
+        self.drv.sync_cookies([{"name": "sid", "value": "secret"}])
+        self.drv.do_webhook({"url": self.url, "body": {"a": 1}})
+        self.drv.do_webhook({"url": self.url, "body": {"a": 2}, "background": True})
+        self.drv.webhookq.queue.join()
+        self.assertEqual(list(self.drv.http.cookies.keys()), ["sid"])
+        self.drv.finish()
+        self.assertEqual(len(HookHandler.received), 2)
+        self.assertEqual(HookHandler.cookies[0], None)
+        self.assertNotIn("sid", HookHandler.cookies[1] or "")